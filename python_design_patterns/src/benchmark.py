@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# @File         : benchmark.py
+# @Project      : src
+# @Time         : 2026/10/17 10:20
+# @Site         : https://github.com/MaiXiaochai
+# @Author       : maixiaochai
+
+import json
+import time
+import platform
+import statistics
+
+"""
+基准测试工具：
+    timeit.Timer().timeit()只给出一个总耗时，看不出波动，也分不清冷缓存和热缓存。这里的Benchmark提供：
+        1）预热（warmup）后重复采样（repeat），统计每次调用耗时的min/mean/median/stdev/p95/p99/max；
+        2）两种模式：
+            warm：setup只执行一次，之后反复调用，测的是缓存命中后的耗时；
+            cold：每个样本之前都执行一次setup（比如cache_clear()），每个样本只调用一次，测的是冷启动耗时；
+        3）把结果保存为JSON，并与保存好的基线比较，中位数变慢超过tolerance的用例视为性能回退。
+
+用法：
+    bench = Benchmark('decorator_pattern')
+    bench.add('fbncd(100) warm', lambda: fbncd(100))
+    bench.add('fbncd(100) cold', lambda: fbncd(100), setup=fbncd.cache_clear, cold=True)
+    results = bench.run()
+    bench.report()
+    bench.save('bench.json')
+    bench.compare('baseline.json')
+"""
+
+
+def percentile(values, p):
+    """
+    最近秩法(nearest-rank)求百分位数
+    :param values:      list    已排好序的数值
+    :param p:           float   百分位，0~100
+    :return:            float
+    """
+    if not values:
+        raise ValueError('values must not be empty')
+
+    rank = max(int(-(-p * len(values) // 100)), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(samples, number=1):
+    """
+    :param samples:     list    每个样本的总耗时（秒）
+    :param number:      int     每个样本内调用的次数
+    :return:            dict    每次调用的耗时统计（秒）
+    """
+    per_call = sorted(sample / number for sample in samples)
+    median = statistics.median(per_call)
+    return {'samples': len(per_call),
+            'number': number,
+            'min': per_call[0],
+            'mean': statistics.fmean(per_call),
+            'median': median,
+            'stdev': statistics.stdev(per_call) if len(per_call) > 1 else 0.0,
+            'p95': percentile(per_call, 95),
+            'p99': percentile(per_call, 99),
+            'max': per_call[-1],
+            'ops': 1 / median if median else float('inf')}
+
+
+def measure(func, setup=None, cold=False, number=None, repeat=30, warmup=3, min_time=0.01, timer=time.perf_counter):
+    """
+    测量一个无参函数的耗时。
+    warm模式下number为None时自动选择每个样本的调用次数，使一个样本至少耗时min_time秒，减小计时误差。
+    :param func:        obj     被测函数，无参数
+    :param setup:       obj     准备函数，无参数；warm模式只执行一次，cold模式每个样本前执行一次
+    :param cold:        bool    是否为冷启动模式
+    :param number:      int     warm模式下每个样本内调用的次数
+    :param repeat:      int     样本数
+    :param warmup:      int     正式采样前预热的样本数（cold模式下同样先执行setup）
+    :param min_time:    float   自动选择number时每个样本的最短耗时（秒）
+    :param timer:       obj     计时函数
+    :return:            dict    见summarize()
+    """
+    if cold:
+        samples = []
+        for i in range(warmup + repeat):
+            if setup is not None:
+                setup()
+            start = timer()
+            func()
+            elapsed = timer() - start
+            if i >= warmup:
+                samples.append(elapsed)
+        return summarize(samples)
+
+    if setup is not None:
+        setup()
+
+    for _ in range(warmup):
+        func()
+
+    if number is None:
+        number = 1
+        while True:
+            start = timer()
+            for _ in range(number):
+                func()
+            if timer() - start >= min_time:
+                break
+            number *= 2
+
+    samples = []
+    for _ in range(repeat):
+        start = timer()
+        for _ in range(number):
+            func()
+        samples.append(timer() - start)
+    return summarize(samples, number)
+
+
+class Benchmark:
+    """
+    一组基准测试用例（suite）。
+    cases按添加顺序保存用例，results保存最近一次run()的结果。
+    """
+    def __init__(self, name, repeat=30, warmup=3, min_time=0.01):
+        """
+        :param name:        str     suite名称，写入JSON
+        :param repeat:      int     默认样本数
+        :param warmup:      int     默认预热样本数
+        :param min_time:    float   warm模式下每个样本的最短耗时（秒）
+        """
+        self.name = name
+        self.repeat = repeat
+        self.warmup = warmup
+        self.min_time = min_time
+        self.cases = []
+        self.results = {}
+
+    def add(self, name, func, setup=None, cold=False, number=None, repeat=None):
+        """
+        添加一个用例，参数含义见measure()。
+        :param name:        str     用例名称，在suite内唯一
+        :return:            obj     self，便于链式调用
+        """
+        if any(case['name'] == name for case in self.cases):
+            raise ValueError('Duplicate benchmark case: {}'.format(name))
+
+        self.cases.append({'name': name, 'func': func, 'setup': setup, 'cold': cold,
+                           'number': number, 'repeat': self.repeat if repeat is None else repeat})
+        return self
+
+    def run(self):
+        self.results = {}
+        for case in self.cases:
+            stats = measure(case['func'], case['setup'], case['cold'], case['number'], case['repeat'],
+                            self.warmup, self.min_time)
+            stats['mode'] = 'cold' if case['cold'] else 'warm'
+            self.results[case['name']] = stats
+        return self.results
+
+    def report(self):
+        print('{:<32} {:>5} {:>12} {:>12} {:>12} {:>12}'.format('case', 'mode', 'median(us)', 'p95(us)',
+                                                               'p99(us)', 'stdev(us)'))
+        for name, stats in self.results.items():
+            print('{:<32} {:>5} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}'.format(
+                name, stats['mode'], stats['median'] * 1e6, stats['p95'] * 1e6, stats['p99'] * 1e6,
+                stats['stdev'] * 1e6))
+
+    def to_dict(self):
+        return {'suite': self.name,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results': self.results}
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+
+    def compare(self, baseline, tolerance=0.2):
+        """
+        与基线比较中位数，打印每个用例的变化，并返回回退的用例。
+        两边都有的用例才会比较。
+        :param baseline:    str     基线JSON文件路径，或已加载的dict
+        :param tolerance:   float   允许变慢的比例，0.2即20%
+        :return:            list    [(用例名称, 基线中位数, 当前中位数, 比值)]
+        """
+        if isinstance(baseline, str):
+            with open(baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+
+        regressions = []
+        for name, stats in self.results.items():
+            old = baseline['results'].get(name)
+            if old is None:
+                continue
+
+            ratio = stats['median'] / old['median'] if old['median'] else float('inf')
+            regressed = ratio > 1 + tolerance
+            print('{:<32} baseline {:>12.3f}us, now {:>12.3f}us, x{:.2f}{}'.format(
+                name, old['median'] * 1e6, stats['median'] * 1e6, ratio, '  REGRESSION' if regressed else ''))
+            if regressed:
+                regressions.append((name, old['median'], stats['median'], ratio))
+
+        return regressions
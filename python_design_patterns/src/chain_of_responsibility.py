@@ -41,6 +41,8 @@ Apache的 Cocoa和Touch框架使用责任链来处理事件。在某个视图接
 单个事件，比如一次鼠标左击，可被多个事件监听者捕获。
 """
 
+import time
+
 # ---------------------------------------------------------------------------------------------------------------------
 # 实现简单的事件系统
 
@@ -56,7 +58,57 @@ class Event:
         return self.name
 
 
-class Widget:
+class DispatchCache:
+    """
+    Widget.handle()的分发缓存。
+    原来每个事件在每一层都要格式化'handle_{}'、hasattr()、getattr()，再递归到父控件，深的控件树里这种反射式的遍历占了大部分时间。
+        handlers：   (控件类, 方法名) -> 该类是否有这个方法，遍历时不再为每个控件做MRO查找和AttributeError；
+        routes：     每个控件自己的{事件名: (跳数, 处理的控件, 处理方法)}，跳数是从该控件到处理它的祖先要经过的parent数，
+                    命中时直接调用，不再遍历。
+    失效：
+        1）类被修改（WidgetMeta.__setattr__/__delattr__）：清空handlers，并使所有routes过期；
+        2）控件的parent被修改（Widget.parent的setter）：使所有routes过期。
+    routes的过期用全局的epoch实现：每个控件记录自己的routes是在哪个epoch建立的，不一致就丢弃重建，修改是O(1)的。
+    在已经处理过事件的控件实例上添加handle_*属性或修改__class__不会被察觉，之后需要调用dispatch_cache.invalidate()。
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.epoch = 0
+
+    def invalidate(self, classes=False):
+        if classes:
+            self.handlers.clear()
+        self.epoch += 1
+
+    def lookup(self, widget, name):
+        """
+        :return:        obj     widget上名为name的方法（绑定方法或实例属性），没有时返回None
+        """
+        if name in widget.__dict__:
+            return widget.__dict__[name]
+
+        key = (type(widget), name)
+        found = self.handlers.get(key)
+        if found is None:
+            found = self.handlers[key] = hasattr(type(widget), name)
+        return getattr(widget, name) if found else None
+
+
+dispatch_cache = DispatchCache()
+
+
+class WidgetMeta(type):
+    """修改Widget子类的属性（比如添加/替换handle_*方法）时使分发缓存失效"""
+    def __setattr__(cls, name, value):
+        type.__setattr__(cls, name, value)
+        dispatch_cache.invalidate(classes=True)
+
+    def __delattr__(cls, name):
+        type.__delattr__(cls, name)
+        dispatch_cache.invalidate(classes=True)
+
+
+class Widget(metaclass=WidgetMeta):
     """
     应用的核心类
     每个控件都有一个到父对象的引用。我们嘉定副对象是一个Widget实例。根据继承规则，任何Widget子类的实例（如MsgText的实例）也是
@@ -67,21 +119,97 @@ class Widget:
     如果控件有parent,则执行parent的handle()方法。如果控件没有parent，但有handle_default()方法，则执行handle_default()。
     """
     def __init__(self, parent=None):
-        self.parent = parent
+        # 新控件还没有被任何路由引用，直接设置_parent，不必使缓存失效
+        self._parent = parent
+        self._routes = {}
+        self._routes_epoch = dispatch_cache.epoch
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        self._parent = parent
+        dispatch_cache.invalidate()
 
     def handle(self, event):
-        handler = 'handle_{}'.format(event)
-        if hasattr(self, handler):
-            # getattr()用于返回一个对象的属性值
-            # getattr(self, handler) get self 对象的handler属性值
-            method = getattr(self, handler)
+        """
+        与dispatch_uncached()的行为相同，但使用DispatchCache：命中时只有一次dict查找和一次调用
+        """
+        name = str(event)
+        if self._routes_epoch == dispatch_cache.epoch:
+            route = self._routes.get(name)
+        else:
+            self._routes = {}
+            self._routes_epoch = dispatch_cache.epoch
+            route = None
+
+        if route is None:
+            route = self.resolve(name)
+
+        method = route[2]
+        if method is not None:
             method(event)
 
-        elif self.parent:
-            self.parent.handle(event)
-
-        elif hasattr(self, 'handle_default'):
-            self.handle_default(event)
+    def resolve(self, name):
+        """
+        找出处理事件name的控件，并把路由缓存到沿途每个控件上（父控件的路由就是少一跳的同一个路由），
+        这样一条深度为n的链上所有控件第一次处理某个事件的总代价是O(n)而不是O(n^2)。
+        :param name:        str     事件名
+        :return:            tuple   (跳数, 处理的控件, 处理方法)，没有控件处理时处理方法为None
+        """
+        handler = 'handle_{}'.format(name)
+        epoch = dispatch_cache.epoch
+        path = []
+        widget = self
+        while True:
+            if widget._routes_epoch != epoch:
+                widget._routes = {}
+                widget._routes_epoch = epoch
+            route = widget._routes.get(name)
+            if route is not None:
+                break
+
+            method = dispatch_cache.lookup(widget, handler)
+            if method is not None:
+                route = (0, widget, method)
+                break
+
+            if not widget._parent:
+                route = (0, widget, dispatch_cache.lookup(widget, 'handle_default'))
+                break
+
+            path.append(widget)
+            widget = widget._parent
+
+        widget._routes[name] = route
+        hops, target, method = route
+        for widget in reversed(path):
+            hops += 1
+            route = widget._routes[name] = (hops, target, method)
+        return route
+
+    def dispatch_uncached(self, event):
+        """
+        原来的handle()，把对父控件的递归改成了循环（上万层的链会超过递归深度限制），仅用于对比
+        """
+        widget = self
+        while True:
+            handler = 'handle_{}'.format(event)
+            if hasattr(widget, handler):
+                # getattr()用于返回一个对象的属性值
+                # getattr(self, handler) get self 对象的handler属性值
+                getattr(widget, handler)(event)
+                return
+
+            elif widget.parent:
+                widget = widget.parent
+
+            else:
+                if hasattr(widget, 'handle_default'):
+                    widget.handle_default(event)
+                return
 
 
 class MainWindow(Widget):
@@ -164,5 +292,87 @@ def main():
         print()
 
 
+class Panel(Widget):
+    """
+    不处理任何事件的中间层控件
+    """
+    pass
+
+
+class CountingWindow(Widget):
+    def __init__(self, parent=None):
+        Widget.__init__(self, parent)
+        self.count = 0
+
+    def handle_close(self, event):
+        self.count += 1
+
+    def handle_default(self, event):
+        self.count += 1
+
+
+class CountingText(Widget):
+    def __init__(self, parent=None):
+        Widget.__init__(self, parent)
+        self.count = 0
+
+    def handle_down(self, event):
+        self.count += 1
+
+
+def dispatch_main(depth=10000, events=10 ** 6, uncached_events=200):
+    """
+    一条depth层的链：CountingWindow <- depth个Panel <- CountingText，向叶子发送事件，比较每个事件的平均耗时（微秒）：
+        down：      叶子自己处理，0跳；
+        close：     根处理，depth + 1跳；
+        unhandled： 没有控件处理，落到根的handle_default()。
+    uncached是原来的反射式遍历（只发送uncached_events个事件），cached是带DispatchCache的handle()（发送events个事件）。
+    最后修改一次parent，检查路由被重新解析。
+    :param depth:           int     中间层的数量
+    :param events:          int     cached模式每种事件的发送次数
+    :param uncached_events: int     uncached模式每种事件的发送次数
+    :return:
+    """
+    root = CountingWindow()
+    widget = root
+    for _ in range(depth):
+        widget = Panel(widget)
+    leaf = CountingText(widget)
+
+    for name in ('down', 'close', 'unhandled'):
+        event = Event(name)
+
+        start = time.perf_counter()
+        for _ in range(uncached_events):
+            leaf.dispatch_uncached(event)
+        uncached = (time.perf_counter() - start) / uncached_events
+
+        start = time.perf_counter()
+        leaf.handle(event)
+        first = time.perf_counter() - start
+
+        handle = leaf.handle
+        start = time.perf_counter()
+        for _ in range(events):
+            handle(event)
+        cached = (time.perf_counter() - start) / events
+
+        print('{:<10} hops {:>6}, uncached {:>10.2f}us, first cached {:>10.2f}us, cached {:.3f}us, x{:.0f}'.format(
+            name, leaf.resolve(name)[0], uncached * 1e6, first * 1e6, cached * 1e6, uncached / cached))
+
+    print('handled: root {}, leaf {}'.format(root.count, leaf.count))
+
+    # 把叶子直接挂到根上，close的路由应该从depth + 1跳变为1跳
+    leaf.parent = root
+    leaf.handle(Event('close'))
+    print('after reparenting: close hops {}'.format(leaf.resolve('close')[0]))
+
+    # 给类添加处理方法，路由应该立即改为叶子自己处理
+    CountingText.handle_close = CountingText.handle_down
+    leaf.handle(Event('close'))
+    print('after patching CountingText: close hops {}, leaf {}'.format(leaf.resolve('close')[0], leaf.count))
+    del CountingText.handle_close
+
+
 if __name__ == '__main__':
     main()
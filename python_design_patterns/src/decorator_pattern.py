@@ -6,8 +6,23 @@
 # @Site         : https://github.com/MaiXiaochai
 # @Author       : maixiaochai
 
-from timeit import Timer
-from functools import wraps
+import os
+import sys
+import time
+import types
+import pickle
+import asyncio
+import inspect
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, partial
+from collections import OrderedDict, defaultdict, namedtuple
+
+from benchmark import Benchmark
 
 
 """
@@ -96,22 +111,668 @@ def nsum(n):
 # 这个模块逐步变得不必要地复杂。如何保持递归函数与朴素版本的一样简单，但在性能上又能与使用memoization的函数相近？--修饰器
 
 
-def memoize(fn):
+# ---------------------------------------------------------------------------------------------------------------------
+# known会无限增长：参数取值很多（高基数）时，长期运行的进程最终会因内存耗尽被杀掉。
+# 因此给memoize加上可选的容量上限和淘汰策略（LRU、LFU、TTL），并提供命中、未命中、淘汰次数及占用字节数的统计，
+# 便于根据线上数据来确定缓存大小，而不是靠猜。
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions maxsize currsize nbytes')
+
+# 缓存未命中的标记。不能用None，因为None本身也可能是被缓存的结果
+_MISSING = object()
+
+
+class CacheStore:
+    """
+    memoize使用的缓存。
+    容量满（maxsize）时，policy决定淘汰哪一项：
+        lru：最久未被访问的项；
+        lfu：访问次数最少的项，次数相同时淘汰其中最久未被访问的；
+        ttl：最早写入（也就是最早过期）的项。
+    ttl不为None时，任何策略下的项都在写入ttl秒后过期，过期项在读取时被清除并计入evictions。
+    nbytes是键和值的sys.getsizeof()之和，只计算浅层大小，用于估算。
+    """
+    def __init__(self, maxsize=None, policy='lru', ttl=None, timer=time.monotonic):
+        """
+        :param maxsize:     int     最多缓存的项数，None表示不限
+        :param policy:      str     淘汰策略，'lru'、'lfu'或'ttl'
+        :param ttl:         float   缓存项的存活秒数，None表示永不过期
+        :param timer:       obj     返回当前时间（秒）的函数，默认time.monotonic
+        """
+        if policy not in ('lru', 'lfu', 'ttl'):
+            raise ValueError('Unknown cache policy: {}'.format(policy))
+
+        if policy == 'ttl' and ttl is None:
+            raise ValueError("Cache policy 'ttl' requires ttl")
+
+        if maxsize is not None and maxsize <= 0:
+            raise ValueError('maxsize must be > 0')
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.ttl = ttl
+        self.timer = timer
+        self.clear()
+
+    def clear(self):
+        """清空缓存并将所有计数器归零"""
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.deadlines = {}
+        # LFU使用：key -> 访问次数，访问次数 -> 该次数下按访问先后排列的key
+        self.freq = {}
+        self.buckets = defaultdict(OrderedDict)
+        self.min_freq = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key):
+        """
+        :param key:     obj     可哈希的键
+        :return:        obj     缓存的值，未命中（含已过期）时返回_MISSING
+        """
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+
+        if self.ttl is not None and self.deadlines[key] <= self.timer():
+            self.discard(key)
+            self.evictions += 1
+            self.misses += 1
+            return _MISSING
+
+        self.hits += 1
+        if self.policy == 'lru' and self.maxsize is not None:
+            self.data.move_to_end(key)
+        elif self.policy == 'lfu':
+            self._touch(key)
+        return value
+
+    def set(self, key, value):
+        if key in self.data:
+            self.discard(key)
+
+        if self.policy == 'ttl':
+            self._expire()
+
+        if self.maxsize is not None and len(self.data) >= self.maxsize:
+            self._evict()
+
+        self.data[key] = value
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        self.sizes[key] = size
+        self.nbytes += size
+
+        if self.ttl is not None:
+            self.deadlines[key] = self.timer() + self.ttl
+
+        if self.policy == 'lfu':
+            self.freq[key] = 1
+            self.buckets[1][key] = None
+            self.min_freq = 1
+
+    def discard(self, key):
+        """删除一项（不计入evictions），key不存在时什么也不做"""
+        if key not in self.data:
+            return
+
+        del self.data[key]
+        self.nbytes -= self.sizes.pop(key)
+        self.deadlines.pop(key, None)
+
+        if self.policy == 'lfu':
+            count = self.freq.pop(key)
+            bucket = self.buckets[count]
+            del bucket[key]
+            if not bucket:
+                del self.buckets[count]
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.data), self.nbytes)
+
+    def _touch(self, key):
+        """LFU：把key的访问次数加1，并移到新次数的桶里"""
+        count = self.freq[key]
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if self.min_freq == count:
+                self.min_freq = count + 1
+
+        self.freq[key] = count + 1
+        self.buckets[count + 1][key] = None
+
+    def _expire(self):
+        """TTL：data按写入顺序排列，也就是按过期时间排列，因此只需从头部清理"""
+        now = self.timer()
+        while self.data:
+            key = next(iter(self.data))
+            if self.deadlines[key] > now:
+                break
+            self.discard(key)
+            self.evictions += 1
+
+    def _evict(self):
+        if self.policy == 'lfu':
+            if self.min_freq not in self.buckets:
+                # 次数最少的那一项被discard()删掉了，重新找出最小次数
+                self.min_freq = min(self.buckets)
+            key = next(iter(self.buckets[self.min_freq]))
+        else:
+            key = next(iter(self.data))
+
+        self.discard(key)
+        self.evictions += 1
+
+
+class _Call:
     """
-    该修饰器接受一个需要使用memoization的函数fn作为输入，使用一个名为known的dict作为缓存。
+    某个key正在进行中的一次计算。
+    第一个调用者（leader）负责计算，同一个key的其它调用者在event上等待，计算完成后直接取value或重新抛出error。
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def memoize(fn=None, *, maxsize=None, policy='lru', ttl=None, concurrent=False):
+    """
+    该修饰器接受一个需要使用memoization的函数fn作为输入，使用一个名为known的CacheStore作为缓存。
     warps能保留被它修饰的函数的文档和签名。推荐使用。
     这里设置了参数列表*args,因为被修饰的函数有可能有输入参数。
-    :param fn:      obj     函数
-    :return:        obj     函数
+
+    既可以直接使用@memoize（不限容量，与最初的dict版本行为一致），
+    也可以带参数使用，如@memoize(maxsize=1024, policy='lfu')或@memoize(policy='ttl', ttl=60)。
+    参数只能以关键字传入，@memoize(128)会立即抛出TypeError，而不是把128当作被修饰的函数。
+    fn是async def定义的协程函数时，自动改用amemoize。
+    concurrent=True时为线程安全的single-flight模式：同一个冷key只有第一个线程执行fn，其它线程等待并共享它的结果；
+    锁只在读写缓存时短暂持有，fn在锁外执行，因此不同key之间互不阻塞。fn抛出的异常会传给所有等待者，但不会被缓存。
+    被修饰的函数多了两个方法：
+        cache_info()：  返回CacheInfo(hits, misses, evictions, maxsize, currsize, nbytes)；
+        cache_clear()： 清空缓存和计数器。
+    :param fn:          obj     函数
+    :param maxsize:     int     最多缓存的项数，None表示不限
+    :param policy:      str     淘汰策略，'lru'、'lfu'或'ttl'
+    :param ttl:         float   缓存项的存活秒数，None表示永不过期
+    :param concurrent:  bool    是否启用线程安全的single-flight模式
+    :return:            obj     函数
+    """
+    if fn is not None and not callable(fn):
+        raise TypeError('memoize() options are keyword-only, e.g. @memoize(maxsize=128)')
+
+    if fn is None:
+        return partial(memoize, maxsize=maxsize, policy=policy, ttl=ttl, concurrent=concurrent)
+
+    if inspect.iscoroutinefunction(fn):
+        # 直接缓存会缓存协程对象本身，第二次await就会出错，交给amemoize处理
+        return amemoize(fn, maxsize=maxsize, policy=policy, ttl=ttl)
+
+    known = CacheStore(maxsize, policy, ttl)
+
+    if concurrent:
+        return _single_flight(fn, known)
+
+    @wraps(fn)
+    def memoizer(*args):
+        value = known.get(args)
+        if value is _MISSING:
+            value = fn(*args)
+            known.set(args, value)
+        return value
+
+    memoizer.cache_info = known.info
+    memoizer.cache_clear = known.clear
+    return memoizer
+
+
+def _single_flight(fn, known):
+    """
+    memoize(concurrent=True)的实现。
+    calls记录每个正在计算的key对应的_Call；lock同时保护known和calls。
+    写入缓存和移除_Call在同一次加锁中完成，因此后来的调用者要么命中缓存，要么等待同一个_Call，不会重复计算。
     """
-    known = dict()
+    lock = threading.Lock()
+    calls = {}
 
     @wraps(fn)
     def memoizer(*args):
-        if args not in known:
-            known[args] = fn(*args)
-        return known[args]
+        with lock:
+            value = known.get(args)
+            if value is not _MISSING:
+                return value
 
+            call = calls.get(args)
+            leader = call is None
+            if leader:
+                call = calls[args] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with lock:
+                if call.error is None:
+                    known.set(args, call.value)
+                del calls[args]
+            call.event.set()
+
+        return call.value
+
+    def cache_clear():
+        with lock:
+            known.clear()
+
+    memoizer.cache_info = known.info
+    memoizer.cache_clear = cache_clear
+    return memoizer
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# memoize修饰过的nsum、fbncd仍然是每一步递归占用一个Python栈帧：冷启动的nsum(5000)会超过递归深度限制(RecursionError)，
+# 每一层调用也都有开销。对于"参数是单个整数、只依赖更小参数"的自递归函数，可以自底向上地预热缓存：
+# 从base开始依次计算fn(base), fn(base + 1), ..., fn(n)，计算fn(k)时它递归调用的更小的值都已在缓存中，
+# 因此每次最多只深入一层，再大的n也不会触发RecursionError。
+
+
+def memoize_bottom_up(fn=None, *, base=0, window=None):
+    """
+    自底向上预热的memoization修饰器，适用于只有一个整数参数n、且fn(n)只递归调用fn(k)(base <= k < n)的函数。
+    被修饰的函数内部仍然按朴素递归的写法调用自己（调用的是修饰后的函数），写法与@memoize完全一样。
+    top记录已连续算到的最大值，再次调用更大的n时只从top + 1继续计算。
+
+    window不为None时只保留最近的window个结果（比如斐波那契数列只需要前两项），
+    计算上百万项时内存保持不变；之后访问更小且已被丢弃的n会从base重新计算。
+    :param fn:          obj     函数
+    :param base:        int     最小的参数值，小于base的n直接调用fn且不缓存
+    :param window:      int     只保留最近的window个结果，None表示全部保留
+    :return:            obj     函数
+    """
+    if fn is not None and not callable(fn):
+        raise TypeError('memoize_bottom_up() options are keyword-only, e.g. @memoize_bottom_up(window=2)')
+
+    if fn is None:
+        return partial(memoize_bottom_up, base=base, window=window)
+
+    known = CacheStore()
+    top = base - 1
+
+    @wraps(fn)
+    def memoizer(n):
+        nonlocal top
+        value = known.get(n)
+        if value is not _MISSING:
+            return value
+
+        if n < base:
+            return fn(n)
+
+        if n <= top:
+            # 只有n已被window丢弃时才会走到这里，从头再算
+            known.clear()
+            top = base - 1
+
+        for k in range(top + 1, n + 1):
+            value = fn(k)
+            known.set(k, value)
+            if window is not None:
+                known.discard(k - window)
+            top = k
+
+        return value
+
+    def cache_clear():
+        nonlocal top
+        known.clear()
+        top = base - 1
+
+    memoizer.cache_info = known.info
+    memoizer.cache_clear = cache_clear
+    return memoizer
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# 进程每次重启，memoize建好的缓存就全部丢失，每次部署都要重新预热。
+# 下面把缓存保存到sqlite文件里：键是参数的稳定哈希，并按被修饰函数的代码计算版本号，函数改动后旧结果自动作废。
+
+
+def _stable_repr(const):
+    """
+    与repr()相同，但结果在每次运行时都一样：
+        1）集合中的元素和dict的项按repr排序，字符串的哈希随PYTHONHASHSEED变化，{'a', 'b'}的repr顺序每次都可能不同；
+        2）函数、类和只有默认repr的对象（含内存地址，如object()哨兵）用“模块.限定名”表示。
+    """
+    if isinstance(const, (set, frozenset)):
+        return '{}({{{}}})'.format(type(const).__name__, ', '.join(sorted(map(_stable_repr, const))))
+    if isinstance(const, tuple):
+        return '({})'.format(', '.join(map(_stable_repr, const)))
+    if isinstance(const, list):
+        return '[{}]'.format(', '.join(map(_stable_repr, const)))
+    if isinstance(const, dict):
+        return '{{{}}}'.format(', '.join(sorted('{}: {}'.format(_stable_repr(k), _stable_repr(v))
+                                                for k, v in const.items())))
+    if isinstance(const, (type, types.FunctionType, types.BuiltinFunctionType)):
+        return '<{}.{}>'.format(const.__module__, const.__qualname__)
+    if type(const).__repr__ is object.__repr__:
+        return '<{}.{} object>'.format(type(const).__module__, type(const).__qualname__)
+    return repr(const)
+
+
+def _canonical(obj):
+    """
+    把参数中的集合换成按元素pickle结果排序的元组，使pickle的结果不随PYTHONHASHSEED变化
+    """
+    if isinstance(obj, (set, frozenset)):
+        items = sorted((_canonical(item) for item in obj), key=lambda item: pickle.dumps(item, protocol=4))
+        return type(obj).__name__, tuple(items)
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_canonical(item) for item in obj)
+    if isinstance(obj, dict):
+        return {_canonical(k): _canonical(v) for k, v in obj.items()}
+    return obj
+
+
+def code_version(fn):
+    """
+    根据字节码、常量（包括嵌套的函数）和用到的名字计算函数的版本号，传入函数时还包括参数的默认值
+    （def f(x, scale=2)改成scale=3后结果不同，缓存必须作废）。
+    不包含文件名和行号，因此只移动函数的位置不会让缓存作废；Python版本不同时字节码不同，版本号也会不同。
+    :param fn:      obj     函数，或代码对象（如fn.__code__）
+    :return:        str     十六进制的sha256摘要
+    """
+    code = getattr(fn, '__code__', fn)
+    digest = hashlib.sha256(code.co_code)
+    if code is not fn:
+        digest.update(_stable_repr(fn.__defaults__).encode())
+        digest.update(_stable_repr(fn.__kwdefaults__).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            digest.update(code_version(const).encode())
+        else:
+            digest.update(_stable_repr(const).encode())
+    digest.update(repr(code.co_names).encode())
+    return digest.hexdigest()
+
+
+class SqliteStore:
+    """
+    memoize_disk使用的持久化缓存，所有函数共用一张memo表，以(name, key)为主键。
+        key：      参数pickle后的sha256，同样的参数在不同进程、不同次运行中得到同样的key；
+        version：  code_version()的结果，打开时删除本函数所有版本不一致的行；
+        atime：    最近访问时间，写入时设置；命中时先记在touched里，攒够touch_batch个（或淘汰、关闭之前）再批量更新，
+                   超过maxsize时批量删除最久没有访问的行(LRU)，直到剩下maxsize的90%。
+    sqlite使用WAL日志模式，多个进程可以同时读，写入时互相等待（最多timeout秒）。
+    连接按进程创建，fork出的子进程会重新打开自己的连接；同一进程内的线程通过lock共用一个连接。
+    memory是进程内的一级缓存，preload=True时在打开连接后一次性把本函数的所有行读进来。
+    """
+    # 命中的访问时间攒够多少个再写回磁盘
+    touch_batch = 256
+
+    def __init__(self, path, name, version, maxsize=None, preload=True, timeout=30):
+        """
+        :param path:        str     sqlite文件路径
+        :param name:        str     函数的全名(模块名.限定名)
+        :param version:     str     函数的代码版本
+        :param maxsize:     int     本函数最多保存的行数，None表示不限
+        :param preload:     bool    打开时是否把所有行读入内存
+        :param timeout:     float   等待其它进程释放写锁的秒数
+        """
+        if maxsize is not None and maxsize <= 0:
+            raise ValueError('maxsize must be > 0')
+
+        self.path = path
+        self.name = name
+        self.version = version
+        self.maxsize = maxsize
+        self.preload = preload
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+        self.memory = {}
+        self.touched = {}
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._conn = None
+        self._pid = None
+
+    @staticmethod
+    def key(args):
+        return hashlib.sha256(pickle.dumps(_canonical(args), protocol=4)).digest()
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._open()
+        return self._conn
+
+    def _open(self):
+        # isolation_level=None：自己用BEGIN IMMEDIATE控制事务
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS memo ('
+                     'name TEXT NOT NULL, key BLOB NOT NULL, version TEXT NOT NULL, '
+                     'value BLOB NOT NULL, atime REAL NOT NULL, PRIMARY KEY (name, key))')
+        conn.execute('CREATE INDEX IF NOT EXISTS memo_atime ON memo (name, atime)')
+
+        stale = conn.execute('SELECT 1 FROM memo WHERE name = ? AND version != ? LIMIT 1',
+                             (self.name, self.version)).fetchone()
+        if stale:
+            conn.execute('DELETE FROM memo WHERE name = ? AND version != ?', (self.name, self.version))
+
+        self._conn = conn
+        self._pid = os.getpid()
+        self.memory = {}
+        self.touched = {}
+        self.rows = conn.execute('SELECT COUNT(*) FROM memo WHERE name = ?', (self.name,)).fetchone()[0]
+
+        if self.preload:
+            cursor = conn.execute('SELECT key, value FROM memo WHERE name = ?', (self.name,))
+            self.memory = {key: pickle.loads(value) for key, value in cursor}
+
+    def get(self, key):
+        with self.lock:
+            conn = self.conn
+            try:
+                value = self.memory[key]
+            except KeyError:
+                # 可能是其它进程在本进程打开之后写入的
+                row = conn.execute('SELECT value FROM memo WHERE name = ? AND key = ?', (self.name, key)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return _MISSING
+                value = self.memory[key] = pickle.loads(row[0])
+
+            self.hits += 1
+            self.touched[key] = time.time()
+            if len(self.touched) >= self.touch_batch:
+                self._touch(conn)
+            return value
+
+    def _touch(self, conn):
+        """把攒下的访问时间批量写回"""
+        if self.touched:
+            conn.executemany('UPDATE memo SET atime = ? WHERE name = ? AND key = ?',
+                             [(atime, self.name, key) for key, atime in self.touched.items()])
+            self.touched = {}
+
+    def set(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            conn = self.conn
+            now = time.time()
+            try:
+                conn.execute('INSERT INTO memo (name, key, version, value, atime) VALUES (?, ?, ?, ?, ?)',
+                             (self.name, key, self.version, data, now))
+            except sqlite3.IntegrityError:
+                # 已经有这一行（比如其它进程刚写入），覆盖它，行数不变
+                conn.execute('UPDATE memo SET version = ?, value = ?, atime = ? WHERE name = ? AND key = ?',
+                             (self.version, data, now, self.name, key))
+            else:
+                self.rows += 1
+            self.memory[key] = value
+            self.touched.pop(key, None)
+
+            if self.maxsize is not None and self.rows > self.maxsize:
+                self._touch(conn)
+                self._evict(conn)
+
+    def _evict(self, conn):
+        """批量淘汰，避免每次写入都删一行"""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('SELECT COUNT(*) FROM memo WHERE name = ?', (self.name,)).fetchone()[0]
+            excess = rows - self.maxsize * 9 // 10
+            keys = []
+            if rows > self.maxsize and excess > 0:
+                keys = [key for key, in conn.execute('SELECT key FROM memo WHERE name = ? ORDER BY atime LIMIT ?',
+                                                     (self.name, excess))]
+                conn.executemany('DELETE FROM memo WHERE name = ? AND key = ?', [(self.name, key) for key in keys])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        for key in keys:
+            self.memory.pop(key, None)
+        self.evictions += len(keys)
+        self.rows = rows - len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM memo WHERE name = ?', (self.name,))
+            self.memory = {}
+            self.touched = {}
+            self.rows = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        with self.lock:
+            rows, nbytes = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(key) + LENGTH(value)), 0) '
+                                             'FROM memo WHERE name = ?', (self.name,)).fetchone()
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, rows, nbytes)
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._touch(self._conn)
+                self._conn.close()
+            self._conn = None
+
+
+def memoize_disk(fn=None, *, path='memoize.sqlite3', maxsize=None, preload=True):
+    """
+    把结果持久化到sqlite文件的memoization修饰器，进程重启后无需重新预热。
+    参数和返回值都必须能被pickle。连接在第一次调用时才打开（同时完成预加载），因此修饰本身不访问磁盘。
+    被修饰的函数多了cache_info()、cache_clear()和cache_close()三个方法，cache_info()中的nbytes是磁盘上键和值的字节数。
+    :param fn:          obj     函数
+    :param path:        str     sqlite文件路径
+    :param maxsize:     int     最多保存的结果数，None表示不限
+    :param preload:     bool    打开时是否把已保存的结果全部读入内存
+    :return:            obj     函数
+    """
+    if fn is not None and not callable(fn):
+        raise TypeError('memoize_disk() options are keyword-only, e.g. @memoize_disk(maxsize=128)')
+
+    if fn is None:
+        return partial(memoize_disk, path=path, maxsize=maxsize, preload=preload)
+
+    known = SqliteStore(path, '{}.{}'.format(fn.__module__, fn.__qualname__), code_version(fn),
+                        maxsize, preload)
+
+    @wraps(fn)
+    def memoizer(*args):
+        key = known.key(args)
+        value = known.get(key)
+        if value is _MISSING:
+            value = fn(*args)
+            known.set(key, value)
+        return value
+
+    memoizer.cache_info = known.info
+    memoizer.cache_clear = known.clear
+    memoizer.cache_close = known.close
+    return memoizer
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# 协程函数的memoization：缓存await后的结果，而不是协程对象。
+
+
+def amemoize(fn=None, *, maxsize=None, policy='lru', ttl=None):
+    """
+    用于async def函数的memoization修饰器，参数含义与memoize相同。
+    tasks记录每个key正在运行的Task，同一个key的并发await共享这一个Task，因此fn只执行一次。
+    每个等待者通过asyncio.shield()等待，其中一个被取消不会取消共享的Task。
+    Task完成后由_settle()从tasks中移除，只有正常返回的结果才写入缓存，异常和取消都不缓存，下次调用会重新执行。
+    同一个被修饰的函数只应在一个事件循环中使用。
+    :param fn:          obj     协程函数
+    :param maxsize:     int     最多缓存的项数，None表示不限
+    :param policy:      str     淘汰策略，'lru'、'lfu'或'ttl'
+    :param ttl:         float   缓存项的存活秒数，None表示永不过期
+    :return:            obj     协程函数
+    """
+    if fn is not None and not callable(fn):
+        raise TypeError('amemoize() options are keyword-only, e.g. @amemoize(maxsize=128)')
+
+    if fn is None:
+        return partial(amemoize, maxsize=maxsize, policy=policy, ttl=ttl)
+
+    known = CacheStore(maxsize, policy, ttl)
+    tasks = {}
+
+    def _settle(args, task):
+        if tasks.get(args) is task:
+            del tasks[args]
+
+        if not task.cancelled() and task.exception() is None:
+            known.set(args, task.result())
+
+    @wraps(fn)
+    async def memoizer(*args):
+        value = known.get(args)
+        if value is not _MISSING:
+            return value
+
+        task = tasks.get(args)
+        if task is None:
+            task = tasks[args] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(partial(_settle, args))
+
+        return await asyncio.shield(task)
+
+    def cache_clear():
+        known.clear()
+        tasks.clear()
+
+    memoizer.cache_info = known.info
+    memoizer.cache_clear = cache_clear
     return memoizer
 
 
@@ -140,45 +801,240 @@ def fbncd(n):
     return n if n in (0, 1) else fbncd(n - 1) + fbncd(n - 2)
 
 
-def main_test():
+@memoize_bottom_up
+def nsum_bottom_up(n):
+    """
+    返回前n个数字的和，自底向上预热，n可以达到上百万
+    :param n:       int     整数
+    :return:        int     前n个数字的和
+    """
+    assert(n >= 0), 'n must be >= 0'
+    return 0 if n == 0 else n + nsum_bottom_up(n - 1)
+
+
+@memoize_bottom_up(window=2)
+def fbncd_bottom_up(n):
+    """
+    返回菲波那切数列第n个数，自底向上预热，只保留最近两项
+    :param n:
+    :return:
+    """
+    assert(n >= 0), 'n must be >= 0'
+    return n if n in (0, 1) else fbncd_bottom_up(n - 1) + fbncd_bottom_up(n - 2)
+
+
+def reset_fbnc():
+    """把fbnc使用的全局缓存known恢复为初始状态，供冷启动测试使用"""
+    known.clear()
+    known.update({0: 0, 1: 1})
+
+
+def decorator_suite():
+    """
+    fibonacci/fbnc/fbncd/nsum的基准测试用例，冷、热缓存分开测量。
+    fibonacci没有缓存，只测一种模式。
+    :return:        obj     Benchmark
+    """
+    bench = Benchmark('decorator_pattern')
+    bench.add('fibonacci(8)', lambda: fibonacci(8))
+    bench.add('fbnc(100) cold', lambda: fbnc(100), setup=reset_fbnc, cold=True)
+    bench.add('fbnc(100) warm', lambda: fbnc(100))
+
+    for func, arg in ((fbncd, 100), (nsum, 200), (fbncd_bottom_up, 100), (nsum_bottom_up, 200)):
+        name = '{}({})'.format(func.__name__, arg)
+        bench.add(name + ' cold', partial(func, arg), setup=func.cache_clear, cold=True)
+        bench.add(name + ' warm', partial(func, arg))
+
+    return bench
+
+
+def main_test(output=None, baseline=None, tolerance=0.2):
     """
     展示如何使用被修饰的函数，并测试其性能。
-    measure是一个字典列表，用于避免代码重复。
     __name__和__doc__分别是如何展示正确的函数名称和文档字符串值的。
+    测试用例见decorator_suite()，每个用例预热后重复采样，报告中位数和p95/p99。
+    :param output:      str     结果JSON的保存路径，None表示不保存
+    :param baseline:    str     基线JSON路径，None表示不比较
+    :param tolerance:   float   允许变慢的比例
+    :return:            list    性能回退的用例，见Benchmark.compare()
+
+    Out（示例）:
+    name: fbncd, doc: 返回菲波那切数列第n个数
+    name: nsum, doc: 返回前n个数字的和
+    case                              mode   median(us)      p95(us)      p99(us)    stdev(us)
+    fibonacci(8)                      warm        5.016        5.140        5.322        0.058
+    fbnc(100) cold                    cold       27.170       29.271       33.524        1.335
+    fbnc(100) warm                    warm        0.072        0.073        0.074        0.001
+    fbncd(100) cold                   cold      122.209      138.109      142.657        8.054
+    fbncd(100) warm                   warm        0.316        0.318        0.321        0.002
+    ...
+    """
+    for func in (fbncd, nsum):
+        print('name: {}, doc: {}'.format(func.__name__, func.__doc__.strip().splitlines()[0]))
+
+    bench = decorator_suite()
+    bench.run()
+    bench.report()
+
+    if output is not None:
+        bench.save(output)
+
+    regressions = []
+    if baseline is not None:
+        regressions = bench.compare(baseline, tolerance)
+    return regressions
+
+
+def concurrent_main(delay=0.01, keys=8, calls_per_thread=32):
+    """
+    比较普通memoize与concurrent=True在1~64个线程下的吞吐量。
+    slow_square用time.sleep()模拟一次代价很大的调用（比如远程查询），sleep期间会释放GIL。
+    所有线程从同一组冷key开始访问，executed是fn实际被执行的次数：
+    普通版本中多个线程会同时计算同一个冷key，single-flight版本中每个key只计算一次。
+    :param delay:               float   每次真正计算耗时（秒）
+    :param keys:                int     不同key的个数
+    :param calls_per_thread:    int     每个线程的调用次数
     :return:
+    """
+    for concurrent in (False, True):
+        for threads in (1, 2, 4, 8, 16, 32, 64):
+            executed = []
 
-    Out:
-    name: fbncd,doc:
-    返回菲波那切数列第n个数
-    :param n:
+            @memoize(concurrent=concurrent)
+            def slow_square(x):
+                executed.append(x)
+                time.sleep(delay)
+                return x * x
+
+            def worker(_):
+                for i in range(calls_per_thread):
+                    slow_square(i % keys)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(worker, range(threads)))
+            elapsed = time.perf_counter() - start
+
+            print('concurrent: {}, threads: {:>2}, executed: {:>3}, '
+                  'calls/s: {:.0f}'.format(concurrent, threads, len(executed),
+                                           threads * calls_per_thread / elapsed))
+
+
+def bottom_up_main(n=400, repeat=200):
+    """
+    比较冷缓存下memoize与memoize_bottom_up的耗时，并演示后者在百万级n下不会RecursionError。
+    memoize版本每一层递归占用两个栈帧（memoizer和fn），n超过约490就会RecursionError，因此对比时n取400。
+    每次计时前都调用cache_clear()，保证测的是冷调用。
+    :param n:           int     对比用的n
+    :param repeat:      int     重复次数
     :return:
-    ,executing: fbncd(100), time: 0.23861463099999997
+    """
+    cases = [('nsum', nsum, nsum_bottom_up),
+             ('fbncd', fbncd, fbncd_bottom_up)]
 
-    name: nsum,doc:
-    返回前n个数字的和
-    :param n:       int     整数
-    :return:        int     前n个数字的和
-    ,executing: nsum(200), time: 0.24195961499999996
-    """
-
-    measure = [
-        {'exec': 'fbncd(100)',
-         'import': 'fbncd',
-         'func': fbncd},
-        {'exec': 'nsum(200)',
-         'import': 'nsum',
-         'func': nsum}
-    ]
-
-    for m in measure:
-        t = Timer('{}'.format(m['exec']), 'from __main__ import {}'.format(m['import']))
-        print('name: {},'
-              'doc: {},'
-              'executing: {}, '
-              'time: {}'.format(m['func'].__name__,
-                                m['func'].__doc__,
-                                m['exec'],
-                                t.timeit()))
+    for name, recursive, bottom_up in cases:
+        times = []
+        for func in (recursive, bottom_up):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func.cache_clear()
+                func(n)
+            times.append((time.perf_counter() - start) / repeat)
+
+        print('cold {}({}): memoize {:.6f}s, memoize_bottom_up {:.6f}s, '
+              'speedup x{:.2f}'.format(name, n, times[0], times[1], times[0] / times[1]))
+
+    for func, big in ((nsum_bottom_up, 10 ** 6), (fbncd_bottom_up, 10 ** 5)):
+        func.cache_clear()
+        start = time.perf_counter()
+        value = func(big)
+        print('cold {}({}): {:.3f}s, result has {} bits'.format(func.__name__, big, time.perf_counter() - start,
+                                                                value.bit_length()))
+
+
+def slow_cube(x):
+    """模拟一次代价很大的计算，供disk_main()使用"""
+    time.sleep(0.01)
+    return x ** 3
+
+
+def _disk_reader(path, keys):
+    """
+    disk_main()的子进程：模拟重启后的新进程，用同一个文件重新修饰slow_cube。
+    :return:    tuple   (耗时, cache_info)
+    """
+    cube = memoize_disk(slow_cube, path=path)
+    start = time.perf_counter()
+    for x in range(keys):
+        cube(x)
+    return time.perf_counter() - start, cube.cache_info()
+
+
+def disk_main(keys=200, readers=4):
+    """
+    演示memoize_disk：第一个进程冷启动计算并写入，之后多个"重启后"的进程同时读取，全部命中，不再计算。
+    :param keys:        int     不同参数的个数
+    :param readers:     int     同时读取的进程数
+    :return:
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'memoize.sqlite3')
+
+        cube = memoize_disk(slow_cube, path=path)
+        start = time.perf_counter()
+        for x in range(keys):
+            cube(x)
+        print('cold process: {:.3f}s, {}'.format(time.perf_counter() - start, cube.cache_info()))
+        cube.cache_close()
+
+        with multiprocessing.Pool(readers) as pool:
+            for elapsed, info in pool.starmap(_disk_reader, [(path, keys)] * readers):
+                print('restarted process: {:.3f}s, {}'.format(elapsed, info))
+
+        small = memoize_disk(slow_cube, path=path, maxsize=50)
+        small(keys + 1)
+        print('after capping at 50 rows: {}'.format(small.cache_info()))
+        small.cache_close()
+
+
+def async_main(awaiters=1000):
+    """
+    演示amemoize：
+        1）awaiters个并发await同一个冷key，fetch只执行一次；
+        2）ttl过期后重新执行；
+        3）抛出的异常不会被缓存。
+    :param awaiters:    int     并发await的个数
+    :return:
+    """
+    executed = []
+
+    @memoize(ttl=0.05)
+    async def fetch(x):
+        executed.append(x)
+        await asyncio.sleep(0.01)
+        if x < 0:
+            raise ValueError('x must be >= 0')
+        return x * 2
+
+    async def run():
+        start = time.perf_counter()
+        results = await asyncio.gather(*[fetch(1) for _ in range(awaiters)])
+        print('{} awaiters: results {}, executed {} time(s), {:.4f}s'.format(
+            awaiters, set(results), len(executed), time.perf_counter() - start))
+
+        await fetch(1)
+        await asyncio.sleep(0.06)
+        await fetch(1)
+        print('after ttl expired: executed {} time(s), {}'.format(len(executed), fetch.cache_info()))
+
+        for _ in range(2):
+            try:
+                await fetch(-1)
+            except ValueError as e:
+                print('Error: {}'.format(e))
+        print('exceptions are not cached: executed {} time(s)'.format(len(executed)))
+
+    asyncio.run(run())
 
 
 def main():
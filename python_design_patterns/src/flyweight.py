@@ -6,8 +6,20 @@
 # @Site         : https://github.com/MaiXiaochai
 # @Author       : maixiaochai
 
+import io
+import os
+import sys
+import time
+import struct
 import random
+import weakref
+import threading
+import tracemalloc
 from enum import Enum
+from functools import partial
+from array import array
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 """
 享元模式(flyweight)：
@@ -47,6 +59,107 @@ memoization 与 享元模式间的区别：
 
 tree_type_all = Enum('TreeType', 'apple_tree cherry_tree peach_tree')
 
+# Tree.render()和Forest.render()共用的输出格式，保证两者输出一致
+RENDER_FORMAT = 'render a tree of type {} at ({}, {})'
+
+PoolInfo = namedtuple('PoolInfo', 'hits creations evictions size')
+
+
+class FlyweightPool:
+    """
+    线程安全的享元对象池。
+    普通dict做对象池有两个问题：
+        1）查找和创建之间没有锁，两个线程可能为同一个key各创建一个享元；
+        2）只增不减，没人再用的享元永远留在内存里。
+
+    这里用一把锁保护"查找-创建-登记"整个过程，并提供两种回收方式：
+        weak=True：  池中只保存弱引用，享元在外部没有引用后被回收，回调中将其移出池并计入evictions；
+        maxsize：    强引用模式下超过容量时淘汰最久未使用的享元；
+                     弱引用模式下表示额外用强引用保留最近使用的maxsize个享元，避免热门享元刚用完就被回收，
+                     None表示不额外保留。
+    hits、creations、evictions分别统计命中、创建和回收次数，creations远小于hits + creations时说明享元确实节省了内存。
+    """
+    def __init__(self, weak=False, maxsize=None):
+        """
+        :param weak:        bool    是否只保存弱引用
+        :param maxsize:     int     强引用保留的最多享元数，强引用模式下None表示不限
+        """
+        if maxsize is not None and maxsize < 0:
+            raise ValueError('maxsize must be >= 0')
+
+        self.weak = weak
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.strong = OrderedDict()
+        self.refs = {}
+        self.hits = 0
+        self.creations = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.refs) if self.weak else len(self.strong)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def get(self, key, factory, *args):
+        """
+        返回key对应的享元，不存在时调用factory(*args)创建。
+        :param key:         obj     可哈希的固有状态
+        :param factory:     obj     创建享元的函数
+        :return:            obj     享元
+        """
+        with self.lock:
+            obj = self._lookup(key)
+            if obj is not None:
+                self.hits += 1
+            else:
+                obj = factory(*args)
+                self.creations += 1
+                if self.weak:
+                    self.refs[key] = weakref.ref(obj, partial(self._reap, key))
+
+            self._keep(key, obj)
+            return obj
+
+    def _lookup(self, key):
+        if not self.weak:
+            return self.strong.get(key)
+
+        ref = self.refs.get(key)
+        return None if ref is None else ref()
+
+    def _keep(self, key, obj):
+        """登记强引用，并按LRU淘汰超出maxsize的部分"""
+        if self.weak and not self.maxsize:
+            return
+
+        self.strong[key] = obj
+        self.strong.move_to_end(key)
+
+        if self.maxsize is not None:
+            while len(self.strong) > self.maxsize:
+                self.strong.popitem(last=False)
+                if not self.weak:
+                    self.evictions += 1
+
+    def _reap(self, key, ref):
+        """
+        弱引用回调，享元被回收时调用。
+        回调可能在任意线程、甚至在持有self.lock时由垃圾回收触发，因此不能加锁，只做单步的dict操作。
+        """
+        if self.refs.get(key) is ref:
+            self.refs.pop(key, None)
+            self.evictions += 1
+
+    def info(self):
+        return PoolInfo(self.hits, self.creations, self.evictions, len(self))
+
+    def clear(self):
+        with self.lock:
+            self.strong.clear()
+            self.refs.clear()
+
 
 class Tree:
     """
@@ -64,26 +177,513 @@ class Tree:
          __init__不需要返回值。
 
         [参考文献：https://blog.csdn.net/qq_37616069/article/details/79476249]
+
+    pool是一个FlyweightPool，查找和创建在同一把锁内完成，多线程下同一种类的树也只会创建一次。
+    需要回收没人使用的享元时，可以替换为Tree.pool = FlyweightPool(weak=True)。
     """
-    pool = dict()
+    pool = FlyweightPool()
 
     def __new__(cls, tree_type):
-        obj = cls.pool.get(tree_type, None)
+        return cls.pool.get(tree_type, cls._create, tree_type)
 
-        if not obj:
-            obj = object.__new__(cls)
-            cls.pool[tree_type] = obj
-            obj.tree_type = tree_type
+    @classmethod
+    def _create(cls, tree_type):
+        obj = object.__new__(cls)
+        obj.tree_type = tree_type
         return obj
 
-    def render(self, age, x, y):
+    def render(self, age, x, y, sink=None):
         """
         享元不知道的所有可变（外部）信息都需要由客户端代码显示地传递。
         每棵树都用到一个随机的年龄和一个x，y形式的位置。为了让render()更加有用，
         有必要确保没有树会被渲染到另一棵上。
         render 渲染，着色
+        sink为None时直接print，否则交给RenderSink缓冲后批量写出。
+        """
+        if sink is None:
+            print(RENDER_FORMAT.format(self.tree_type, age, x, y))
+        else:
+            sink.render(self.tree_type, age, x, y)
+
+
+# -------------------------------------------------------------------------------------------------------------------
+"""
+Tree.pool共享了固有状态，但外部状态（age, x, y）仍然是一次render()调用传一次，再print一次。
+一千万棵树就是一千万次Python调用和字符串格式化，外部状态还分散在一千万个元组里。
+
+Forest按列保存外部状态：
+    types：     类型码数组，kinds[code]就是Tree.pool中对应的享元；
+    ages/xs/ys：与types等长的平行数组。
+array中的每个元素只占itemsize个字节，不再是一个个Python对象，因此每棵树只需要1 + 2 + 4 + 4 = 11个字节。
+批量接口（extend、render、count、iter_type）一次处理整列。
+"""
+
+
+class Forest:
+    def __init__(self):
+        self.kinds = []
+        self.codes = {}
+        self.types = array('B')
+        self.ages = array('H')
+        self.xs = array('i')
+        self.ys = array('i')
+
+    def __len__(self):
+        return len(self.types)
+
+    def code(self, tree_type):
+        """
+        返回tree_type的类型码，第一次出现时从Tree.pool中取出（或创建）享元并登记。
+        :param tree_type:   obj     树的种类
+        :return:            int     类型码
+        """
+        code = self.codes.get(tree_type)
+        if code is None:
+            if len(self.kinds) >= 256:
+                raise ValueError('Too many tree types: {}'.format(len(self.kinds)))
+            code = self.codes[tree_type] = len(self.kinds)
+            self.kinds.append(Tree(tree_type))
+        return code
+
+    def add(self, tree_type, age, x, y):
+        # 先转换并检查所有列的值（越界时抛出OverflowError），再一起追加，保证各列长度一致
+        row = array('H', [age]), array('i', [x]), array('i', [y])
+        self.types.append(self.code(tree_type))
+        self.ages.extend(row[0])
+        self.xs.extend(row[1])
+        self.ys.extend(row[2])
+
+    def extend(self, tree_type, ages, xs, ys):
+        """
+        批量添加同一种类的树
+        :param tree_type:   obj     树的种类
+        :param ages:        list    年龄序列
+        :param xs:          list    x坐标序列，长度与ages相同
+        :param ys:          list    y坐标序列，长度与ages相同
+        """
+        count = len(ages)
+        if len(xs) != count or len(ys) != count:
+            raise ValueError('ages, xs and ys must have the same length')
+
+        ages, xs, ys = array('H', ages), array('i', xs), array('i', ys)
+        self.types.extend(array('B', [self.code(tree_type)]) * count)
+        self.ages.extend(ages)
+        self.xs.extend(xs)
+        self.ys.extend(ys)
+
+    def __iter__(self):
+        """按添加顺序逐棵返回(享元, age, x, y)"""
+        kinds = self.kinds
+        for code, age, x, y in zip(self.types, self.ages, self.xs, self.ys):
+            yield kinds[code], age, x, y
+
+    def iter_type(self, tree_type):
+        """逐棵返回某一种类的(age, x, y)"""
+        code = self.codes.get(tree_type)
+        if code is None:
+            return
+        for c, age, x, y in zip(self.types, self.ages, self.xs, self.ys):
+            if c == code:
+                yield age, x, y
+
+    def count(self, tree_type):
+        code = self.codes.get(tree_type)
+        return 0 if code is None else self.types.count(code)
+
+    def nbytes(self):
+        """外部状态占用的字节数（不含array对象本身的头部）"""
+        return sum(column.itemsize * len(column) for column in (self.types, self.ages, self.xs, self.ys))
+
+    def rows(self, start=0, stop=None):
         """
-        print('render a tree of type {} at ({}, {})'.format(self.tree_type, age, x, y))
+        把[start, stop)范围内的树渲染成文本行，与Tree.render()输出的格式相同。
+        每种类型的前缀只格式化一次，其余按列批量处理。
+        :return:            list    文本行
+        """
+        stop = len(self) if stop is None else stop
+        names = [str(tree.tree_type) for tree in self.kinds]
+        return list(map(RENDER_FORMAT.format, [names[code] for code in self.types[start:stop]],
+                        self.ages[start:stop], self.xs[start:stop], self.ys[start:stop]))
+
+    def render(self, out=None, chunk=65536):
+        """
+        批量渲染：每chunk棵树拼成一个字符串，只调用一次write()。
+        :param out:         obj     有write()方法的对象，默认sys.stdout
+        :param chunk:       int     每次写入的树的棵数
+        """
+        out = sys.stdout if out is None else out
+        for start in range(0, len(self), chunk):
+            out.write('\n'.join(self.rows(start, start + chunk)))
+            out.write('\n')
+
+
+# -------------------------------------------------------------------------------------------------------------------
+"""
+Tree.render()每棵树print()一次，也就是一次格式化加一次write系统调用（终端是行缓冲的），大森林的瓶颈在stdout上。
+RenderSink把渲染结果先收集在缓冲区里，攒够buffer_size字节再一次性写给target，target可以是：
+    内存：   RenderSink.memory()，写入io.BytesIO；
+    文件：   RenderSink.open(path)；
+    管道：   任何以二进制方式打开、有write()方法的对象，如RenderSink(sys.stdout.buffer)或os.fdopen(fd, 'wb')。
+只有RenderSink.open()打开的文件由close()关闭，其它target由调用者负责关闭。
+binary=True时不再格式化文本，每棵树写成一条定长二进制记录RECORD：类型码(B)、年龄(H)、x(i)、y(i)，共11字节，
+类型码对应的种类见kinds，读回时用RenderSink.read_records()。
+"""
+
+
+class RenderSink:
+    RECORD = struct.Struct('<BHii')
+
+    def __init__(self, target, binary=False, buffer_size=1 << 16, owns=False):
+        """
+        :param target:          obj     有write(bytes)方法的对象
+        :param binary:          bool    是否输出二进制记录
+        :param buffer_size:     int     缓冲区达到多少字节时写出
+        :param owns:            bool    close()时是否关闭target
+        """
+        self.target = target
+        self.owns = owns
+        self.binary = binary
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.lines = []
+        self.pending = 0
+        self.kinds = []
+        self.codes = {}
+        self.rows = 0
+
+    @classmethod
+    def memory(cls, binary=False, buffer_size=1 << 16):
+        return cls(io.BytesIO(), binary, buffer_size)
+
+    @classmethod
+    def open(cls, path, binary=False, buffer_size=1 << 16):
+        return cls(open(path, 'wb'), binary, buffer_size, owns=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def code(self, tree_type):
+        code = self.codes.get(tree_type)
+        if code is None:
+            code = self.codes[tree_type] = len(self.kinds)
+            self.kinds.append(tree_type)
+        return code
+
+    def render(self, tree_type, age, x, y):
+        """渲染一棵树"""
+        if self.binary:
+            self.buffer += self.RECORD.pack(self.code(tree_type), age, x, y)
+        else:
+            # 文本行先放在列表里，flush时一次编码，比逐行encode快
+            line = RENDER_FORMAT.format(tree_type, age, x, y)
+            self.lines.append(line)
+            self.pending += len(line) + 1
+        self.rows += 1
+
+        if self.pending + len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def render_forest(self, forest, chunk=65536):
+        """
+        按列批量渲染一整片Forest，每chunk棵树只做一次拼接
+        :param forest:      obj     Forest
+        :param chunk:       int     每批的棵数
+        """
+        codes = [self.code(tree.tree_type) for tree in forest.kinds]
+        pack = self.RECORD.pack
+
+        for start in range(0, len(forest), chunk):
+            stop = min(start + chunk, len(forest))
+            if self.binary:
+                self.buffer += b''.join(map(pack, [codes[code] for code in forest.types[start:stop]],
+                                            forest.ages[start:stop], forest.xs[start:stop], forest.ys[start:stop]))
+            else:
+                self._drain()
+                self.buffer += ('\n'.join(forest.rows(start, stop)) + '\n').encode()
+            self.rows += stop - start
+
+            if self.pending + len(self.buffer) >= self.buffer_size:
+                self.flush()
+
+    def _drain(self):
+        """把逐行渲染暂存的文本行编码进buffer"""
+        if self.lines:
+            self.buffer += ('\n'.join(self.lines) + '\n').encode()
+            self.lines = []
+            self.pending = 0
+
+    def flush(self):
+        self._drain()
+        if self.buffer:
+            self.target.write(self.buffer)
+            self.buffer = bytearray()
+        if hasattr(self.target, 'flush'):
+            self.target.flush()
+
+    def getvalue(self):
+        """内存sink中已写出的全部内容（会先flush）"""
+        self.flush()
+        return self.target.getvalue()
+
+    def close(self):
+        self.flush()
+        if self.owns:
+            self.target.close()
+            self.owns = False
+
+    @classmethod
+    def read_records(cls, data, kinds):
+        """
+        把二进制输出解析回(tree_type, age, x, y)
+        :param data:        bytes   二进制输出
+        :param kinds:       list    写出时sink的kinds
+        :return:            obj     生成器
+        """
+        for code, age, x, y in cls.RECORD.iter_unpack(data):
+            yield kinds[code], age, x, y
+
+
+# -------------------------------------------------------------------------------------------------------------------
+"""
+Tree.render()要求树不能被渲染到另一棵上，但两两比较是O(n²)的。
+SpatialGrid是按(x, y)划分的均匀网格，每个格子（cell）边长为cell_size，记录落在其中的点：
+    1）insert、occupied只访问一个格子，O(1)；
+    2）collides(x, y, radius)在radius <= cell_size时只需检查周围3×3个格子，O(1)；
+    3）nearest(x, y)从所在格子开始一圈一圈向外找，找到的点比下一圈可能的最近距离还近时停止。
+把cell_size设为树之间的最小间距，种N棵互不重叠的树总共只需O(N)次格子访问。
+"""
+
+
+class SpatialGrid:
+    def __init__(self, cell_size=1):
+        """
+        :param cell_size:   float   格子的边长
+        """
+        if cell_size <= 0:
+            raise ValueError('cell_size must be > 0')
+
+        self.cell_size = cell_size
+        self.cells = {}
+        self.size = 0
+        # 非空格子坐标的范围，nearest()用它决定最多找几圈
+        self.bounds = None
+
+    def __len__(self):
+        return self.size
+
+    def cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def insert(self, x, y, item=None):
+        """
+        :param x:       float   x坐标
+        :param y:       float   y坐标
+        :param item:    obj     与该点关联的对象，如树在Forest中的下标
+        """
+        cx, cy = key = self.cell(x, y)
+        self.cells.setdefault(key, []).append((x, y, item))
+        self.size += 1
+
+        if self.bounds is None:
+            self.bounds = [cx, cy, cx, cy]
+        else:
+            bounds = self.bounds
+            bounds[0], bounds[1] = min(bounds[0], cx), min(bounds[1], cy)
+            bounds[2], bounds[3] = max(bounds[2], cx), max(bounds[3], cy)
+
+    def occupied(self, x, y):
+        """(x, y)所在的格子中是否已经有点"""
+        return self.cell(x, y) in self.cells
+
+    def points(self, x, y):
+        """(x, y)所在格子中的所有点[(x, y, item)]"""
+        return self.cells.get(self.cell(x, y), [])
+
+    def collides(self, x, y, radius):
+        """
+        是否存在与(x, y)距离小于radius的点
+        :return:        bool
+        """
+        cx, cy = self.cell(x, y)
+        reach = int(-(-radius // self.cell_size))
+        limit = radius * radius
+        cells = self.cells
+
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                for px, py, _ in cells.get((i, j), ()):
+                    if (px - x) ** 2 + (py - y) ** 2 < limit:
+                        return True
+        return False
+
+    def nearest(self, x, y):
+        """
+        离(x, y)最近的点
+        :return:        tuple   (距离, x, y, item)，网格为空时返回None
+        """
+        if not self.cells:
+            return None
+
+        cx, cy = self.cell(x, y)
+        min_cx, min_cy, max_cx, max_cy = self.bounds
+        max_ring = max(abs(cx - min_cx), abs(cx - max_cx), abs(cy - min_cy), abs(cy - max_cy))
+        best = None
+
+        for ring in range(max_ring + 1):
+            for key in self._ring(cx, cy, ring):
+                for px, py, item in self.cells.get(key, ()):
+                    distance = ((px - x) ** 2 + (py - y) ** 2) ** 0.5
+                    if best is None or distance < best[0]:
+                        best = (distance, px, py, item)
+
+            # 第ring + 1圈及更外面的点，距离至少是ring * cell_size
+            if best is not None and best[0] <= ring * self.cell_size:
+                break
+
+        return best
+
+    @staticmethod
+    def _ring(cx, cy, ring):
+        """以(cx, cy)为中心、第ring圈的所有格子"""
+        if ring == 0:
+            yield cx, cy
+            return
+
+        for i in range(cx - ring, cx + ring + 1):
+            yield i, cy - ring
+            yield i, cy + ring
+        for j in range(cy - ring + 1, cy + ring):
+            yield cx - ring, j
+            yield cx + ring, j
+
+
+def plant_forest(n, width, height, min_distance, rnd=None, attempts=100):
+    """
+    在[0, width] × [0, height]范围内随机种下n棵树，任意两棵树的距离都不小于min_distance。
+    :param n:               int     树的棵数
+    :param width:           int     宽度
+    :param height:          int     高度
+    :param min_distance:    float   最小间距
+    :param rnd:             obj     random.Random实例
+    :param attempts:        int     每棵树最多尝试的随机位置数，都失败说明区域太挤
+    :return:                tuple   (Forest, SpatialGrid)
+    """
+    rnd = random.Random() if rnd is None else rnd
+    tree_types = list(tree_type_all)
+    forest = Forest()
+    grid = SpatialGrid(min_distance)
+
+    for i in range(n):
+        for _ in range(attempts):
+            x, y = rnd.randint(0, width), rnd.randint(0, height)
+            if not grid.collides(x, y, min_distance):
+                break
+        else:
+            raise ValueError('Cannot place tree {} without overlapping, the area is too crowded'.format(i))
+
+        grid.insert(x, y, len(forest))
+        forest.add(tree_types[rnd.randrange(len(tree_types))], rnd.randint(1, 30), x, y)
+
+    return forest, grid
+
+
+# -------------------------------------------------------------------------------------------------------------------
+"""
+通用的享元：Tree.__new__只能按单个tree_type缓存，tree_type也存在每个实例的__dict__里。
+FlyweightMeta把这套逻辑做成元类，任何类只要声明__slots__就能成为享元：
+    1）__slots__列出的字段就是固有状态，构造参数按字段顺序（或按字段名）传入，整个参数元组作为池的key；
+    2）只允许__slots__，实例没有__dict__，每个实例只占字段个数个指针；
+    3）实例不可变，构造之后赋值或删除属性都会抛出AttributeError。由于同样的参数总是返回同一个对象，
+       默认基于id的==和hash()就等价于按值比较。
+每个享元类有自己的FlyweightPool，定义类时可以传入weak和maxsize，如：
+    class Glyph(metaclass=FlyweightMeta, weak=True):
+        __slots__ = ('char', 'font')
+"""
+
+
+class FlyweightMeta(type):
+    def __new__(mcs, name, bases, namespace, weak=False, maxsize=None):
+        if '__slots__' not in namespace:
+            raise TypeError('Flyweight class {} must define __slots__'.format(name))
+
+        slots = namespace['__slots__']
+        fields = (slots,) if isinstance(slots, str) else tuple(slots)
+        if weak and '__weakref__' not in fields:
+            namespace['__slots__'] = fields + ('__weakref__',)
+
+        namespace.setdefault('__setattr__', _immutable_setattr)
+        namespace.setdefault('__delattr__', _immutable_delattr)
+        namespace.setdefault('__repr__', _flyweight_repr)
+        namespace.setdefault('__reduce__', _flyweight_reduce)
+
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls._fields = tuple(field for field in fields if field != '__weakref__')
+        cls._pool = FlyweightPool(weak, maxsize)
+        return cls
+
+    def __init__(cls, name, bases, namespace, weak=False, maxsize=None):
+        super().__init__(name, bases, namespace)
+
+    def __call__(cls, *args, **kwargs):
+        if kwargs or len(args) != len(cls._fields):
+            args = cls._bind(args, kwargs)
+        return cls._pool.get(args, cls._build, args)
+
+    def _bind(cls, args, kwargs):
+        """把位置参数和关键字参数统一成按字段顺序排列的元组"""
+        if len(args) > len(cls._fields):
+            raise TypeError('{}() takes {} arguments but {} were given'.format(cls.__name__, len(cls._fields),
+                                                                              len(args)))
+        values = list(args)
+        for field in cls._fields[len(args):]:
+            try:
+                values.append(kwargs.pop(field))
+            except KeyError:
+                raise TypeError('{}() missing argument: {}'.format(cls.__name__, field))
+
+        if kwargs:
+            raise TypeError('{}() got unexpected arguments: {}'.format(cls.__name__, ', '.join(kwargs)))
+        return tuple(values)
+
+    def _build(cls, args):
+        obj = object.__new__(cls)
+        for field, value in zip(cls._fields, args):
+            object.__setattr__(obj, field, value)
+        return obj
+
+
+def _immutable_setattr(self, name, value):
+    raise AttributeError('{} is an immutable flyweight'.format(type(self).__name__))
+
+
+def _immutable_delattr(self, name):
+    raise AttributeError('{} is an immutable flyweight'.format(type(self).__name__))
+
+
+def _flyweight_repr(self):
+    return '{}({})'.format(type(self).__name__,
+                           ', '.join('{}={!r}'.format(field, getattr(self, field)) for field in self._fields))
+
+
+def _flyweight_reduce(self):
+    # 反序列化时重新经过池，得到的仍是同一个享元
+    return type(self), tuple(getattr(self, field) for field in self._fields)
+
+
+class TreeModel(metaclass=FlyweightMeta):
+    """
+    用FlyweightMeta定义的树模型，固有状态是种类和颜色
+    """
+    __slots__ = ('tree_type', 'color')
+
+    def render(self, age, x, y, sink=None):
+        if sink is None:
+            print(RENDER_FORMAT.format(self.tree_type, age, x, y))
+        else:
+            sink.render(self.tree_type, age, x, y)
 
 
 def main():
@@ -103,33 +703,37 @@ def main():
     age_min, age_max = 1, 30
     point_min, point_max = 0, 100
     tree_counter = 0
+    grid = SpatialGrid()
+
+    def free_point():
+        """随机取一个还没有种树的位置，保证树不会被渲染到另一棵上"""
+        while True:
+            x, y = rnd.randint(point_min, point_max), rnd.randint(point_min, point_max)
+            if not grid.occupied(x, y):
+                grid.insert(x, y)
+                return x, y
 
     for _ in range(10):
         t1 = Tree(tree_type_all.apple_tree)
-        t1.render(rnd.randint(age_min, age_max),
-                  rnd.randint(point_min, point_max),
-                  rnd.randint(point_min, point_max))
+        t1.render(rnd.randint(age_min, age_max), *free_point())
         tree_counter += 1
 
     print('-' * 60)
     for _ in range(3):
         t2 = Tree(tree_type_all.cherry_tree)
-        t2.render(rnd.randint(age_min, age_max),
-                  rnd.randint(point_min, point_max),
-                  rnd.randint(point_min, point_max))
+        t2.render(rnd.randint(age_min, age_max), *free_point())
         tree_counter += 1
     print('-' * 60)
 
     for _ in range(5):
         t3 = Tree(tree_type_all.peach_tree)
-        t3.render(rnd.randint(age_min, age_max),
-                  rnd.randint(point_min, point_max),
-                  rnd.randint(point_min, point_max))
+        t3.render(rnd.randint(age_min, age_max), *free_point())
         tree_counter += 1
     print('-' * 60)
 
     print('trees rendered: {}'.format(tree_counter))
     print('tree actually created: {}'.format(len(Tree.pool)))
+    print(Tree.pool.info())
 
     t4 = Tree(tree_type_all.cherry_tree)
     t5 = Tree(tree_type_all.cherry_tree)
@@ -139,6 +743,212 @@ def main():
     print('{} == {} ? {}'.format(id(t5), id(t6), id(t5) == id(t6)))
 
 
+def random_forest(n, rnd=None):
+    """
+    随机生成一片有n棵树的Forest，年龄、坐标范围与main()相同
+    :param n:       int     树的棵数
+    :param rnd:     obj     random.Random实例
+    :return:        obj     Forest
+    """
+    rnd = random.Random() if rnd is None else rnd
+    forest = Forest()
+    tree_types = list(tree_type_all)
+    per_type = -(-n // len(tree_types))
+
+    for i, tree_type in enumerate(tree_types):
+        count = min(per_type, n - i * per_type)
+        if count <= 0:
+            break
+        forest.extend(tree_type,
+                      [rnd.randint(1, 30) for _ in range(count)],
+                      [rnd.randint(0, 100) for _ in range(count)],
+                      [rnd.randint(0, 100) for _ in range(count)])
+    return forest
+
+
+def forest_main(n=10 ** 6, compare=10 ** 5):
+    """
+    统计Forest每棵树占用的内存，以及批量渲染与逐棵Tree.render()的吞吐量（棵/秒）。
+    输出都写入内存中的StringIO，排除终端本身的速度；逐棵渲染只测compare棵，以免耗时太久。
+    :param n:           int     Forest中树的棵数
+    :param compare:     int     逐棵渲染的棵数
+    :return:
+    """
+    forest = random_forest(n)
+    print('trees: {}, extrinsic bytes: {}, bytes per tree: {:.2f}, flyweights: {}'.format(
+        len(forest), forest.nbytes(), forest.nbytes() / len(forest), len(Tree.pool)))
+
+    out = io.StringIO()
+    start = time.perf_counter()
+    forest.render(out)
+    elapsed = time.perf_counter() - start
+    print('Forest.render: {:.0f} trees/s'.format(len(forest) / elapsed))
+
+    out = io.StringIO()
+    stdout, sys.stdout = sys.stdout, out
+    start = time.perf_counter()
+    try:
+        for tree, age, x, y in forest:
+            if compare <= 0:
+                break
+            tree.render(age, x, y)
+            compare -= 1
+    finally:
+        sys.stdout = stdout
+    elapsed = time.perf_counter() - start
+    print('Tree.render: {:.0f} trees/s'.format(out.getvalue().count('\n') / elapsed))
+
+
+def pool_main(threads=32, per_thread=10000):
+    """
+    1）threads个线程同时创建同样三种树，creations应为3；
+    2）弱引用池中，没有外部引用的享元被回收，evictions增加；有外部引用的享元不会被回收。
+    :param threads:         int     线程数
+    :param per_thread:      int     每个线程创建的次数
+    :return:
+    """
+    tree_types = list(tree_type_all)
+    pool, Tree.pool = Tree.pool, FlyweightPool()
+    try:
+        def worker(i):
+            for j in range(per_thread):
+                Tree(tree_types[(i + j) % len(tree_types)])
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(worker, range(threads)))
+        print('strong pool after {} threads: {}'.format(threads, Tree.pool.info()))
+
+        Tree.pool = FlyweightPool(weak=True)
+        kept = Tree(tree_type_all.apple_tree)
+        Tree(tree_type_all.cherry_tree)
+        Tree(tree_type_all.peach_tree)
+        print('weak pool, only apple_tree still referenced: {}'.format(Tree.pool.info()))
+        del kept
+        print('weak pool, nothing referenced: {}'.format(Tree.pool.info()))
+    finally:
+        Tree.pool = pool
+
+
+class PlainTreeModel:
+    """对照组：普通类，每个实例都有自己的__dict__"""
+    def __init__(self, tree_type, color):
+        self.tree_type = tree_type
+        self.color = color
+
+
+class SlotsTreeModel:
+    """对照组：使用__slots__但不共享的类"""
+    __slots__ = ('tree_type', 'color')
+
+    def __init__(self, tree_type, color):
+        self.tree_type = tree_type
+        self.color = color
+
+
+def memory_main(n=10 ** 6):
+    """
+    用tracemalloc统计创建n个对象（并全部保存在列表中）时，平均每个对象占用的字节数。
+    n个对象只有len(tree_type_all) * 2种不同的固有状态，结果中包含列表本身每项8字节的指针。
+
+    Out（示例，64位CPython 3.11）:
+    PlainTreeModel: 1000000 objects, 96.5 bytes/object, 1000000 distinct
+    SlotsTreeModel: 1000000 objects, 56.4 bytes/object, 1000000 distinct
+    TreeModel: 1000000 objects, 8.5 bytes/object, 6 distinct
+    :param n:       int     创建的对象个数
+    :return:
+    """
+    tree_types = list(tree_type_all)
+    colors = ('green', 'red')
+    kinds = [(tree_type, color) for tree_type in tree_types for color in colors]
+
+    for cls in (PlainTreeModel, SlotsTreeModel, TreeModel):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [cls(*kinds[i % len(kinds)]) for i in range(n)]
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        print('{}: {} objects, {:.1f} bytes/object, {} distinct'.format(
+            cls.__name__, len(objects), used / n, len(set(map(id, objects)))))
+        del objects
+
+
+def spatial_main(sizes=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6), naive_limit=2000, min_distance=2):
+    """
+    用plant_forest()种下N棵互不重叠的树，统计每秒种下的棵数；N不超过naive_limit时，再与两两比较的O(n²)做法对比。
+    区域大小随N增长，保持树的密度（约为最大可能密度的10%）不变。
+    :param sizes:           tuple   N的取值
+    :param naive_limit:     int     运行两两比较做法的最大N
+    :param min_distance:    int     最小间距
+    :return:
+    """
+    for n in sizes:
+        side = int((n * 10) ** 0.5 * min_distance)
+        rnd = random.Random(n)
+
+        start = time.perf_counter()
+        forest, grid = plant_forest(n, side, side, min_distance, rnd)
+        elapsed = time.perf_counter() - start
+        line = 'N = {:>7}: grid {:.3f}s ({:.0f} trees/s)'.format(n, elapsed, n / elapsed)
+
+        if n <= naive_limit:
+            rnd = random.Random(n)
+            placed = []
+            start = time.perf_counter()
+            while len(placed) < n:
+                x, y = rnd.randint(0, side), rnd.randint(0, side)
+                if all((px - x) ** 2 + (py - y) ** 2 >= min_distance ** 2 for px, py in placed):
+                    placed.append((x, y))
+            line += ', naive {:.3f}s'.format(time.perf_counter() - start)
+
+        print(line)
+
+    distance, x, y, index = grid.nearest(0, 0)
+    print('nearest tree to (0, 0): #{} at ({}, {}), distance {:.2f}'.format(index, x, y, distance))
+
+
+def sink_main(n=10 ** 6):
+    """
+    比较各种渲染方式每秒渲染的行数。为了公平，print也写到os.devnull而不是终端（终端只会更慢）。
+        print：                 逐棵Tree.render()，即原来的方式；
+        sink per row：          逐棵Tree.render(sink=...)，写入devnull；
+        sink forest text：      RenderSink.render_forest()，文本；
+        sink forest binary：    RenderSink.render_forest()，二进制记录。
+    :param n:       int     树的棵数
+    :return:
+    """
+    forest = random_forest(n)
+
+    def print_path():
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                for tree, age, x, y in forest:
+                    tree.render(age, x, y)
+            finally:
+                sys.stdout = stdout
+
+    def sink_per_row():
+        with RenderSink.open(os.devnull) as sink:
+            for tree, age, x, y in forest:
+                tree.render(age, x, y, sink)
+
+    def sink_forest(binary):
+        with RenderSink.open(os.devnull, binary) as sink:
+            sink.render_forest(forest)
+
+    cases = [('print', print_path),
+             ('sink per row', sink_per_row),
+             ('sink forest text', partial(sink_forest, False)),
+             ('sink forest binary', partial(sink_forest, True))]
+
+    for name, func in cases:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print('{:<20} {:>12.0f} rows/s'.format(name, n / elapsed))
+
+
 if __name__ == '__main__':
     """
     Out:
@@ -165,6 +975,7 @@ if __name__ == '__main__':
     ------------------------------------------------------------
     trees rendered: 18
     tree actually created: 3
+    PoolInfo(hits=15, creations=3, evictions=0, size=3)
     1788111989560 == 1788111989560 ? True
     1788111989560 == 1788112076248 ? False
     """
@@ -23,6 +23,24 @@
 5)当我们希望在一个对象（主持者/发布者/可观察者）发生变化时通知/更新另一个或多个对象的时候，通常会使用观察者模式。
 """
 
+import gc
+import os
+import sys
+import time
+import pickle
+import random
+import asyncio
+import inspect
+import weakref
+import threading
+import itertools
+import contextlib
+import multiprocessing
+from array import array
+from collections import deque
+
+from benchmark import percentile
+
 
 # 实现一个数据格式化程序。默认格式化程序是以十进制格式展示一个数值，我们可以添加/注册十六进制和二进制格式化程序，
 # 当然，我们可以添加/注册更多的格式化程序。每次更新默认格式化程序的值时，已注册的格式化程序就会收到通知，并采取行动。
@@ -32,19 +50,55 @@
 
 
 class Publisher:
-    def __init__(self):
-        self.observers = []
+    """
+    观察者保存在以id(observer)为键的dict中：dict保持插入顺序，add()/remove()都是O(1)，
+    以身份而不是==判断是否重复，观察者不必可哈希。
+    weak为True时只保存观察者的弱引用，观察者在别处没有引用后会被自动删除，发布者不会让它们泄漏。
+    observers不再是内部的list，而是只读的tuple快照：增删观察者只能用add()/remove()，
+    直接对它append()会抛出AttributeError，而不是悄悄地什么都不做。
+    """
+    def __init__(self, weak=False):
+        self.weak = weak
+        self._observers = {}
+        if weak:
+            # 所有弱引用共用一个回调，回调只持有发布者的弱引用，避免观察者的弱引用反过来让发布者无法回收
+            publisher = weakref.ref(self)
+
+            def forget(ref):
+                self_ = publisher()
+                if self_ is not None and self_._observers.get(ref.key) is ref:
+                    # 只删除同一个弱引用，id可能已经被新对象复用
+                    del self_._observers[ref.key]
+
+            self._forget = forget
+
+    @property
+    def observers(self):
+        """按添加顺序排列的、仍然存活的观察者（只读的tuple）"""
+        if not self.weak:
+            return tuple(self._observers.values())
+        return tuple(o for o in (ref() for ref in self._observers.values()) if o is not None)
+
+    def snapshot(self):
+        """当前状态的快照，用于延后/异步投递，见Update"""
+        return Update(getattr(self, 'name', None), getattr(self, 'data', None))
 
     def add(self, observer):
-        if observer not in self.observers:
-            self.observers.append(observer)
-        else:
+        key = id(observer)
+        current = self._observers.get(key)
+        # 弱引用模式下，已死亡的观察者的id可能被新对象复用，此时直接覆盖
+        if current is not None and (not self.weak or current() is observer):
             print('Falied to add: {}'.format(observer))
+            return
+
+        if self.weak:
+            # KeyedRef把键存在弱引用上，回调由此知道该删除哪一项
+            self._observers[key] = weakref.KeyedRef(observer, self._forget, key)
+        else:
+            self._observers[key] = observer
 
     def remove(self, observer):
-        try:
-            self.observers.remove(observer)
-        except ValueError:
+        if self._observers.pop(id(observer), None) is None:
             print('Failed to remove: {}'.format(observer))
 
     def notify(self):
@@ -52,17 +106,33 @@ class Publisher:
         在变化发生时通知所有观察者
         """
         # o.notify(self)这里其实是在调用订阅者本身的notify()方法
+        # 遍历的是副本，观察者在notify()里添加/删除观察者也不会出错
         [o.notify(self) for o in self.observers]
 
+    def notify_batch(self, values):
+        """
+        一次通知发布一批值。
+        有notify_batch(publisher, values)方法的观察者一次收到整批；其它观察者按顺序逐个收到每个值的Update快照。
+        :param values:      obj     值的序列
+        """
+        name = getattr(self, 'name', None)
+        for o in self.observers:
+            batch = getattr(o, 'notify_batch', None)
+            if batch is not None:
+                batch(self, values)
+            else:
+                for value in values:
+                    o.notify(Update(name, value))
+
 
 class DefaultFormatter(Publisher):
-    def __init__(self, name):
+    def __init__(self, name, weak=False):
         """
         调用基类的__init__()方法，因为这在Python中没法自动完成。
         _data，我们使用了名称改变来声明不能直接访问该变量，虽然Python中直接访问一个变量始终是可能的，
         资深开发人员不会去访问_data变量，因为代码中已经声明不应该这样做。
         """
-        Publisher.__init__(self)
+        Publisher.__init__(self, weak)
         self.name = name
         self._data = 0
 
@@ -96,6 +166,29 @@ class DefaultFormatter(Publisher):
             # 如果try里边的语句正常执行，然后就执行else里的语句
             self.notify()
 
+    def update_many(self, values):
+        """
+        批量更新：一次发布整个序列，data变为最后一个值，观察者只收到一次通知（见Publisher.notify_batch()）。
+        值优先保存为紧凑的array('q')，超出64位或需要转换（比如字符串）时退回到int的list。
+        :param values:      obj     值的序列、array或可迭代对象
+        :return:
+        """
+        # 迭代器只能遍历一次，转换失败后退回时需要原始的全部值，先物化为list
+        if not isinstance(values, (array, list, tuple, range)):
+            values = list(values)
+        try:
+            values = array('q', values)
+        except (TypeError, OverflowError):
+            try:
+                values = [int(value) for value in values]
+            except ValueError as e:
+                print("Error: {}".format(e))
+                return
+
+        if values:
+            self._data = values[-1]
+            self.notify_batch(values)
+
 
 class HexFormatter:
     """
@@ -104,6 +197,13 @@ class HexFormatter:
     def notify(self, publisher):
         print("{}: '{}' has now hex data = {}".format(type(self).__name__, publisher.name, hex(publisher.data)))
 
+    def notify_batch(self, publisher, values):
+        """
+        一次把整批格式化到一个字符串里，只调用一次print()
+        """
+        prefix = "{}: '{}' has now hex data = ".format(type(self).__name__, publisher.name)
+        print('\n'.join([prefix + hex(value) for value in values]))
+
 
 class BinaryFormatter:
     """
@@ -112,6 +212,1132 @@ class BinaryFormatter:
     def notify(self, publisher):
         print("{}: '{}' has now bin data = {}".format(type(self).__name__, publisher.name, bin(publisher.data)))
 
+    def notify_batch(self, publisher, values):
+        prefix = "{}: '{}' has now bin data = ".format(type(self).__name__, publisher.name)
+        print('\n'.join([prefix + bin(value) for value in values]))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Publisher.notify()在data的setter里逐个调用观察者的notify()，赋值要等最慢的观察者处理完，
+# 一个阻塞的观察者会卡住所有更新。AsyncPublisher基于asyncio把通知并发地扇出(fan-out)：
+#     1）每个观察者有自己的有界队列(asyncio.Queue)和一个投递任务，发布只是把更新放进各个队列，不等观察者处理；
+#     2）观察者的notify()可以是协程（会被await），也可以是普通方法：普通方法在线程池中执行(run_in_executor)，
+#        即使它会阻塞（比如time.sleep、同步IO）也不会卡住事件循环和发布者；
+#     3）队列满时按policy处理（背压，backpressure）：
+#           block：       await publish()等待队列有空位，发布者被最慢的观察者限速，但不会丢更新；
+#           drop_oldest： 丢掉队列里最旧的一条，放入新的；
+#           drop_newest： 丢掉这条新的更新；
+#        被丢掉的条数计入dropped。
+# 队列中放的是Update快照而不是发布者本身，因为观察者处理时发布者的值可能已经变了。
+
+
+class Update:
+    """发布时刻的快照，与发布者一样有name和data属性，因此HexFormatter等观察者无需修改"""
+    __slots__ = ('name', 'data')
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+
+class AsyncPublisher(Publisher):
+    policies = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, maxsize=64, policy='block'):
+        """
+        :param maxsize:     int     每个观察者队列的容量
+        :param policy:      str     队列满时的处理方式，见policies
+        """
+        if policy not in self.policies:
+            raise ValueError('Unknown backpressure policy: {}'.format(policy))
+
+        Publisher.__init__(self)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queues = {}
+        self.workers = {}
+        self.dropped = 0
+
+    def remove(self, observer):
+        Publisher.remove(self, observer)
+        worker = self.workers.pop(id(observer), None)
+        queue = self.queues.pop(id(observer), None)
+        if queue is not None:
+            # 丢弃还没投递的更新并标记完成，否则正在等待这个队列的join()/aclose()永远不会返回；
+            # 正在处理的那一条由投递任务被取消时的finally标记完成
+            while not queue.empty():
+                queue.get_nowait()
+                queue.task_done()
+        if worker is not None:
+            worker.cancel()
+
+    def _queue(self, observer):
+        """observer的队列，第一次使用时创建队列和投递任务（需要在事件循环中调用）"""
+        queue = self.queues.get(id(observer))
+        if queue is None:
+            queue = self.queues[id(observer)] = asyncio.Queue(self.maxsize)
+            self.workers[id(observer)] = asyncio.ensure_future(self._deliver(observer, queue))
+        return queue
+
+    async def _deliver(self, observer, queue):
+        loop = asyncio.get_running_loop()
+        notify = observer.notify
+        threaded = not inspect.iscoroutinefunction(notify)
+        while True:
+            update = await queue.get()
+            try:
+                if threaded:
+                    # 同一个观察者的更新仍然逐个处理，保持顺序
+                    result = await loop.run_in_executor(None, notify, update)
+                else:
+                    result = notify(update)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print('Failed to notify {}: {}'.format(observer, e))
+            finally:
+                queue.task_done()
+
+    def _offer(self, queue, update):
+        """
+        不等待地放入队列
+        :return:        bool    block策略下队列已满时返回False，其它情况返回True
+        """
+        if queue.full():
+            if self.policy == 'block':
+                return False
+
+            self.dropped += 1
+            if self.policy == 'drop_newest':
+                return True
+
+            queue.get_nowait()
+            queue.task_done()
+
+        queue.put_nowait(update)
+        return True
+
+    def notify(self):
+        """
+        同步发布（data的setter调用的就是它），只把更新放进各个队列。
+        block策略下同步代码没法等待，队列满时抛出RuntimeError，应改用await publish()。
+        """
+        self._fan_out(self.snapshot())
+
+    def notify_batch(self, values):
+        """队列里的每一项仍然是一个值，批量只省去了逐个赋值的开销"""
+        name = getattr(self, 'name', None)
+        for value in values:
+            self._fan_out(Update(name, value))
+
+    def _fan_out(self, update):
+        for observer in self.observers:
+            if not self._offer(self._queue(observer), update):
+                raise RuntimeError('Queue of {} is full, use await publish() with the block policy'.format(observer))
+
+    async def publish(self):
+        """异步发布：只在block策略且队列满时等待，不等待观察者处理"""
+        update = self.snapshot()
+        for observer in self.observers:
+            queue = self._queue(observer)
+            if not self._offer(queue, update):
+                await queue.put(update)
+
+    async def join(self):
+        """等待所有已发布的更新都被观察者处理完"""
+        for queue in list(self.queues.values()):
+            await queue.join()
+
+    async def aclose(self):
+        await self.join()
+        for worker in self.workers.values():
+            worker.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        self.workers.clear()
+        self.queues.clear()
+
+
+class AsyncDefaultFormatter(DefaultFormatter, AsyncPublisher):
+    """
+    异步扇出版本的DefaultFormatter。
+    df.data = x 仍然可用（drop_*策略）；block策略下用 await df.update(x)。
+    """
+    def __init__(self, name, maxsize=64, policy='block'):
+        DefaultFormatter.__init__(self, name)
+        AsyncPublisher.__init__(self, maxsize, policy)
+
+    async def update(self, new_value):
+        try:
+            self._data = int(new_value)
+        except ValueError as e:
+            print("Error: {}".format(e))
+        else:
+            await self.publish()
+
+
+class SlowFormatter:
+    """
+    模拟一个很慢的观察者，每次处理要delay秒
+    """
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.seen = []
+
+    async def notify(self, publisher):
+        await asyncio.sleep(self.delay)
+        self.seen.append(publisher.data)
+
+
+class BlockingFormatter(SlowFormatter):
+    """
+    会阻塞的同步观察者，用time.sleep模拟同步IO
+    """
+    def notify(self, publisher):
+        time.sleep(self.delay)
+        self.seen.append(publisher.data)
+
+
+class CountingFormatter:
+    """
+    很快的观察者，只记录收到的值
+    """
+    def __init__(self):
+        self.seen = []
+
+    def notify(self, publisher):
+        self.seen.append(publisher.data)
+
+
+def async_main(updates=200):
+    """
+    一个快观察者、一个慢的协程观察者和一个会阻塞的同步观察者（各每次10ms）同时订阅，发布updates次：
+        sync：      原来的Publisher，每次赋值都要等阻塞的观察者处理完；
+        其它：      AsyncDefaultFormatter的三种背压策略，publish耗时与慢观察者无关（block策略在队列满后才被限速），
+                    阻塞的观察者在线程池中执行，不会卡住事件循环。
+    :param updates:     int     发布次数
+    :return:
+    """
+    df = DefaultFormatter('sync')
+    df.add(CountingFormatter())
+    df.add(BlockingFormatter())
+    start = time.perf_counter()
+    for i in range(updates // 10):
+        df.data = i
+    print('{:<12} publish {} updates: {:.4f}s'.format('sync', updates // 10, time.perf_counter() - start))
+
+    async def run(policy):
+        adf = AsyncDefaultFormatter(policy, maxsize=32, policy=policy)
+        fast, slow, blocking = CountingFormatter(), SlowFormatter(), BlockingFormatter()
+        adf.add(fast)
+        adf.add(slow)
+        adf.add(blocking)
+
+        start = time.perf_counter()
+        for i in range(updates):
+            await adf.update(i)
+            # 生产者每产生一个值就让出一次事件循环，快观察者得以及时处理
+            await asyncio.sleep(0)
+        published = time.perf_counter() - start
+        await adf.aclose()
+        print('{:<12} publish {} updates: {:.4f}s, fast got {}, slow got {}, blocking got {}, dropped {}, '
+              'slow last = {}'.format(policy, updates, published, len(fast.seen), len(slow.seen), len(blocking.seen),
+                                      adf.dropped, slow.seen[-1]))
+
+    for policy in AsyncPublisher.policies:
+        asyncio.run(run(policy))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# 每次给data赋值都会立即通知，生产者每秒写10万个值，HexFormatter/BinaryFormatter就要格式化10万次，
+# 而观察者只关心最新的值。CoalescingPublisher把一段时间内的更新合并（coalesce），只投递最新的值：
+#     1）notify()只记下“有未投递的更新”，不调用观察者；
+#     2）flush()把当前最新值的快照投递给每个观察者一次，可以由调用者在每个tick（比如每帧、每次事件循环）显式调用；
+#     3）interval不为None时，第一个未投递的更新之后interval秒自动flush（debounce到固定节拍）；
+#     4）max_delay是延迟上限，第一个未投递的更新最多等待max_delay秒，即使调用者忘了tick、之后也不再有写入，
+#        最后一个值也会被投递；
+#     两者都由每个发布者唯一的一个常驻节拍线程(ticker)按截止时间(deadline = 第一个未投递的更新 + min(interval, max_delay))
+#     触发，而不是每个窗口新建一个threading.Timer（每次都是一个新的系统线程）。生产者在Python循环里持续写入时，
+#     节拍线程要等GIL切换（sys.getswitchinterval()，默认5ms）才能运行，所以notify()发现已过截止时间时也会立即flush，
+#     写入期间延迟不会超过截止时间，空闲时则由节拍线程保证；close()停止节拍线程；
+#     5）merged是被后来的值覆盖、从未投递的更新数，dropped是因此少发的通知数（merged × 观察者数），
+#        max_latency是观察到的最大延迟（从第一个未投递的更新到flush）。
+
+
+class CoalescingPublisher(Publisher):
+    def __init__(self, interval=None, max_delay=None):
+        """
+        :param interval:    float   自动flush的间隔（秒），None表示只由调用者flush()
+        :param max_delay:   float   延迟上限（秒），None表示不限制
+        """
+        Publisher.__init__(self)
+        self.interval = interval
+        self.max_delay = max_delay
+        delays = [delay for delay in (interval, max_delay) if delay is not None]
+        self.delay = min(delays) if delays else None
+        # 节拍线程和写入线程都会flush，用RLock保证观察者按顺序收到更新
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.ticker = None
+        self.closed = False
+        self.deadline = None
+        self.pending_since = None
+        self.window_merged = 0
+        self.published = 0
+        self.flushes = 0
+        self.merged = 0
+        self.dropped = 0
+        self.max_latency = 0.0
+
+    def notify(self):
+        with self.lock:
+            now = time.monotonic()
+            self.published += 1
+            if self.pending_since is None:
+                self.pending_since = now
+                if self.delay is not None:
+                    self.deadline = now + self.delay
+                    if self.ticker is None:
+                        self._start_ticker()
+                    self.wakeup.set()
+            else:
+                self.window_merged += 1
+
+            if self.deadline is not None and now >= self.deadline:
+                self.flush()
+
+    def _start_ticker(self):
+        """
+        启动常驻的节拍线程。线程只持有发布者的弱引用，发布者被回收后线程在下一次醒来时退出。
+        """
+        publisher = weakref.ref(self)
+        wakeup = self.wakeup
+
+        def run():
+            while True:
+                self_ = publisher()
+                if self_ is None or self_.closed:
+                    return
+                with self_.lock:
+                    deadline = self_.deadline
+                    if deadline is not None and time.monotonic() >= deadline:
+                        self_.flush()
+                        deadline = None
+                del self_
+                # 没有待投递的更新时也定期醒来，检查发布者是否已被回收
+                timeout = 1.0 if deadline is None else max(deadline - time.monotonic(), 0)
+                wakeup.wait(timeout)
+                wakeup.clear()
+
+        self.ticker = threading.Thread(target=run, name='coalescing-ticker', daemon=True)
+        self.ticker.start()
+
+    def notify_batch(self, values):
+        """一批值只有最后一个会被投递，其余的都算作merged"""
+        with self.lock:
+            self.published += len(values) - 1
+            self.window_merged += len(values) - 1
+            self.notify()
+
+    def flush(self):
+        """
+        把最新值投递给所有观察者
+        :return:        bool    是否有更新被投递
+        """
+        with self.lock:
+            if self.pending_since is None:
+                return False
+
+            self.deadline = None
+            self.max_latency = max(self.max_latency, time.monotonic() - self.pending_since)
+            self.pending_since = None
+            update = self.snapshot()
+            observers = self.observers
+            self.flushes += 1
+            self.merged += self.window_merged
+            self.dropped += self.window_merged * len(observers)
+            self.window_merged = 0
+            [o.notify(update) for o in observers]
+            return True
+
+    def close(self):
+        """停止节拍线程，并投递还没投递的更新"""
+        self.closed = True
+        if self.ticker is not None:
+            self.wakeup.set()
+            self.ticker.join()
+            self.ticker = None
+        return self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {'published': self.published, 'flushes': self.flushes, 'merged': self.merged,
+                    'dropped': self.dropped, 'max_latency': self.max_latency}
+
+
+class CoalescingFormatter(DefaultFormatter, CoalescingPublisher):
+    """
+    合并更新版本的DefaultFormatter，df.data = x 的用法不变，观察者只收到每个间隔/tick内的最新值
+    """
+    def __init__(self, name, interval=None, max_delay=None):
+        DefaultFormatter.__init__(self, name)
+        CoalescingPublisher.__init__(self, interval, max_delay)
+
+
+class FormatCounter:
+    """
+    不打印的格式化观察者，记录格式化次数和最后的结果
+    """
+    def __init__(self, fmt=hex):
+        self.fmt = fmt
+        self.count = 0
+        self.last = None
+
+    def notify(self, publisher):
+        self.last = self.fmt(publisher.data)
+        self.count += 1
+
+
+def coalesce_main(n=100000):
+    """
+    生产者连续写入n个值，比较：
+        immediate：  DefaultFormatter，每次赋值都格式化；
+        interval：   CoalescingFormatter，每1ms由定时器自动flush；
+        tick：       CoalescingFormatter，调用者每1000次写入flush()一次；
+        max_delay：  CoalescingFormatter，没有定时器也没有tick，只靠1ms的延迟上限。
+    :param n:       int     写入次数
+    :return:
+    """
+    cases = [('immediate', lambda: DefaultFormatter('immediate'), None),
+             ('interval', lambda: CoalescingFormatter('interval', interval=0.001), None),
+             ('tick', lambda: CoalescingFormatter('tick'), 1000),
+             ('max_delay', lambda: CoalescingFormatter('max_delay', max_delay=0.001), None)]
+
+    for name, factory, tick in cases:
+        df = factory()
+        observers = [FormatCounter(hex), FormatCounter(bin)]
+        for o in observers:
+            df.add(o)
+
+        start = time.perf_counter()
+        for i in range(n):
+            df.data = i
+            if tick and i % tick == tick - 1:
+                df.flush()
+        if isinstance(df, CoalescingPublisher):
+            df.close()
+        elapsed = time.perf_counter() - start
+
+        print('{:<10} {:.4f}s, formats {:>7}, last {}'.format(
+            name, elapsed, sum(o.count for o in observers), observers[0].last))
+        if isinstance(df, CoalescingPublisher):
+            print('{:<10} {}'.format('', df.stats()))
+
+
+class ListPublisher:
+    """
+    原来基于list的实现，add()里的in和remove()里的list.remove()都是线性的，仅用于对比
+    """
+    def __init__(self):
+        self.observers = []
+
+    def add(self, observer):
+        if observer not in self.observers:
+            self.observers.append(observer)
+
+    def remove(self, observer):
+        self.observers.remove(observer)
+
+    def notify(self):
+        [o.notify(self) for o in self.observers]
+
+
+class NullFormatter:
+    """
+    什么都不做的观察者，基准测试只测发布者本身的开销
+    """
+    def notify(self, publisher):
+        pass
+
+
+def subscribers_main(sizes=(10, 1000, 10 ** 4, 10 ** 5, 10 ** 6), list_limit=10 ** 4):
+    """
+    比较不同订阅者数量下add/notify/remove的总耗时（秒）。
+    list的add/remove是O(n^2)，只测到list_limit个订阅者；weak最后一列是删除所有外部引用后，
+    观察者被自动移除所需的时间和剩下的观察者数。
+    :param sizes:       tuple   订阅者数量
+    :param list_limit:  int     ListPublisher测试的最大订阅者数
+    :return:
+    """
+    def run(publisher, observers):
+        start = time.perf_counter()
+        for o in observers:
+            publisher.add(o)
+        added = time.perf_counter()
+        publisher.notify()
+        notified = time.perf_counter()
+        # 按添加顺序删除，对list来说是最好的情况
+        for o in observers:
+            publisher.remove(o)
+        return added - start, notified - added, time.perf_counter() - notified
+
+    print('{:>8} {:>7} {:>10} {:>10} {:>10}'.format('n', 'storage', 'add', 'notify', 'remove'))
+    for n in sizes:
+        observers = [NullFormatter() for _ in range(n)]
+        cases = [('list', ListPublisher)] if n <= list_limit else []
+        cases += [('dict', Publisher), ('weak', lambda: Publisher(weak=True))]
+        for storage, factory in cases:
+            print('{:>8} {:>7} {:>10.4f} {:>10.4f} {:>10.4f}'.format(n, storage, *run(factory(), observers)))
+
+        publisher = Publisher(weak=True)
+        for o in observers:
+            publisher.add(o)
+        start = time.perf_counter()
+        del observers, o
+        gc.collect()
+        print('{:>8} {:>7} dropped in {:.4f}s, {} left'.format(n, 'weak', time.perf_counter() - start, len(publisher.observers)))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Publisher.notify()在每次变化时调用所有观察者，而很多观察者只关心某个发布者（topic，即发布者的name）
+# 或某个取值范围，成千上万个有选择的订阅者中大多数调用什么都不做。
+# FilteredPublisher的订阅可以声明topic和/或值范围[low, high]（两者同时给出时都要满足），
+# SubscriptionIndex把订阅建成索引，每次更新只调用匹配的观察者：
+#     1）按topic分桶（dict），topic为None的订阅属于“任意topic”桶；
+#     2）每个桶里没有值范围的订阅直接保存，有值范围的订阅放进区间树(IntervalTree)，
+#        查询包含某个值的所有区间是O(log n + k)，k为匹配的订阅数。
+# 一个SubscriptionIndex可以被多个发布者共享，这样topic就能区分不同的发布者。
+
+
+class IntervalTree:
+    """
+    静态的中心区间树(centered interval tree)，区间为闭区间[low, high]。
+    添加/删除只修改区间表并标记为过期，下一次查询时再重建，适合订阅变化少、查询多的场景。
+    """
+    def __init__(self):
+        self.intervals = {}
+        self.root = None
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, key, low, high, value):
+        self.intervals[key] = (low, high, value)
+        self.dirty = True
+
+    def remove(self, key):
+        self.intervals.pop(key)
+        self.dirty = True
+
+    @classmethod
+    def _build(cls, intervals):
+        """
+        节点为(center, 按low升序的区间, 按high降序的区间, 左子树, 右子树)，
+        左子树的区间都在center左边，右子树的都在center右边，跨过center的保存在节点上。
+        """
+        if not intervals:
+            return None
+
+        points = sorted(p for low, high, value in intervals for p in (low, high))
+        center = points[len(points) // 2]
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        by_low = sorted(here, key=lambda i: i[0])
+        by_high = sorted(here, key=lambda i: i[1], reverse=True)
+        return center, by_low, by_high, cls._build(left), cls._build(right)
+
+    def stab(self, x):
+        """
+        :param x:       int     查询的值
+        :return:        list    包含x的所有区间的value
+        """
+        if self.dirty:
+            self.root = self._build(list(self.intervals.values()))
+            self.dirty = False
+
+        result = []
+        node = self.root
+        while node is not None:
+            center, by_low, by_high, left, right = node
+            if x < center:
+                for low, high, value in by_low:
+                    if low > x:
+                        break
+                    result.append(value)
+                node = left
+            elif x > center:
+                for low, high, value in by_high:
+                    if high < x:
+                        break
+                    result.append(value)
+                node = right
+            else:
+                result.extend(value for low, high, value in by_low)
+                break
+        return result
+
+
+class SubscriptionIndex:
+    def __init__(self):
+        # topic -> [没有值范围的订阅{id: observer}, 有值范围的订阅IntervalTree]
+        self.buckets = {}
+        # id(observer) -> topic
+        self.topics = {}
+
+    def __len__(self):
+        return len(self.topics)
+
+    @property
+    def observers(self):
+        return tuple(o for everything, tree in self.buckets.values()
+                     for o in list(everything.values()) + [v for low, high, v in tree.intervals.values()])
+
+    def add(self, observer, topic=None, low=None, high=None):
+        """
+        :param observer:    obj     观察者
+        :param topic:       str     只接收name为topic的发布者的更新，None表示任意发布者
+        :param low:         int     值范围下限（含），None表示不限
+        :param high:        int     值范围上限（含），None表示不限
+        :return:            bool    是否添加成功，同一个观察者在一个索引里只能订阅一次
+        """
+        key = id(observer)
+        if key in self.topics:
+            return False
+
+        everything, tree = self.buckets.setdefault(topic, ({}, IntervalTree()))
+        if low is None and high is None:
+            everything[key] = observer
+        else:
+            tree.add(key, float('-inf') if low is None else low, float('inf') if high is None else high, observer)
+        self.topics[key] = topic
+        return True
+
+    def remove(self, observer):
+        key = id(observer)
+        if key not in self.topics:
+            return False
+
+        topic = self.topics.pop(key)
+        everything, tree = self.buckets[topic]
+        if everything.pop(key, None) is None:
+            tree.remove(key)
+        if not everything and not tree:
+            del self.buckets[topic]
+        return True
+
+    def match(self, topic, value):
+        """
+        :return:        list    订阅了topic（或任意topic）且值范围包含value的观察者
+        """
+        result = []
+        for bucket in (topic, None) if topic is not None else (None,):
+            if bucket not in self.buckets:
+                continue
+            everything, tree = self.buckets[bucket]
+            result.extend(everything.values())
+            if tree:
+                result.extend(tree.stab(value))
+        return result
+
+
+class FilteredPublisher(Publisher):
+    def __init__(self, index=None):
+        """
+        :param index:       obj     SubscriptionIndex，可以在多个发布者之间共享，None表示新建一个
+        """
+        Publisher.__init__(self)
+        self.index = SubscriptionIndex() if index is None else index
+
+    @property
+    def observers(self):
+        return self.index.observers
+
+    def add(self, observer, topic=None, low=None, high=None):
+        if not self.index.add(observer, topic, low, high):
+            print('Falied to add: {}'.format(observer))
+
+    def remove(self, observer):
+        if not self.index.remove(observer):
+            print('Failed to remove: {}'.format(observer))
+
+    def notify(self):
+        [o.notify(self) for o in self.index.match(getattr(self, 'name', None), getattr(self, 'data', None))]
+
+    def notify_batch(self, values):
+        """每个值匹配的观察者不同，逐个值查询索引"""
+        name = getattr(self, 'name', None)
+        for value in values:
+            [o.notify(Update(name, value)) for o in self.index.match(name, value)]
+
+
+class FilteredFormatter(DefaultFormatter, FilteredPublisher):
+    """
+    带订阅过滤的DefaultFormatter，比如 df.add(HexFormatter(), low=0, high=255) 只在值为一个字节时通知
+    """
+    def __init__(self, name, index=None):
+        DefaultFormatter.__init__(self, name)
+        FilteredPublisher.__init__(self, index)
+
+
+class PredicateFormatter:
+    """
+    在观察者内部自己判断是否关心这次更新，对照组：发布者仍然要调用每一个观察者
+    """
+    def __init__(self, topic, low, high):
+        self.topic = topic
+        self.low = low
+        self.high = high
+        self.count = 0
+
+    def notify(self, publisher):
+        if publisher.name == self.topic and self.low <= publisher.data <= self.high:
+            self.count += 1
+
+
+def filter_main(sizes=(100, 1000, 10 ** 4, 10 ** 5), topics=10, updates=1000, seed=1):
+    """
+    n个订阅者各自订阅topics个发布者之一的一个宽度为1000的随机值范围（值域0~10^6），
+    比较每次更新的平均耗时（微秒）：
+        scan：      普通Publisher，每个观察者自己判断（PredicateFormatter）；
+        index：     FilteredFormatter共享一个SubscriptionIndex，只调用匹配的观察者。
+    :param sizes:       tuple   订阅者总数
+    :param topics:      int     发布者数
+    :param updates:     int     更新次数
+    :param seed:        int     随机种子
+    :return:
+    """
+    rng = random.Random(seed)
+    values = [(rng.randrange(topics), rng.randrange(10 ** 6)) for _ in range(updates)]
+
+    print('{:>8} {:>12} {:>12} {:>10}'.format('n', 'scan(us)', 'index(us)', 'matched'))
+    for n in sizes:
+        subscriptions = []
+        for _ in range(n):
+            low = rng.randrange(10 ** 6)
+            subscriptions.append(('t{}'.format(rng.randrange(topics)), low, low + 999))
+
+        scanned = [DefaultFormatter('t{}'.format(i)) for i in range(topics)]
+        predicates = [PredicateFormatter(*sub) for sub in subscriptions]
+        for df in scanned:
+            for o in predicates:
+                df.add(o)
+
+        index = SubscriptionIndex()
+        indexed = [FilteredFormatter('t{}'.format(i), index) for i in range(topics)]
+        counters = [CountingFormatter() for _ in subscriptions]
+        for o, (topic, low, high) in zip(counters, subscriptions):
+            indexed[0].add(o, topic, low, high)
+        # 每个topic的区间树在第一次查询时才建立，不计入平均值
+        for df in indexed:
+            df.data = 0
+        for o in counters:
+            o.seen.clear()
+
+        timings = []
+        # 和timeit一样计时期间关闭gc，几十万个对象会让偶发的完整回收淹没notify本身的耗时
+        gc.disable()
+        for publishers in (scanned, indexed):
+            start = time.perf_counter()
+            for topic, value in values:
+                publishers[topic].data = value
+            timings.append((time.perf_counter() - start) / updates * 1e6)
+        gc.enable()
+
+        matched = sum(len(o.seen) for o in counters)
+        assert matched == sum(o.count for o in predicates)
+        print('{:>8} {:>12.2f} {:>12.2f} {:>10}'.format(n, timings[0], timings[1], matched))
+
+
+def batch_main(n=10 ** 6):
+    """
+    向挂着HexFormatter和BinaryFormatter的DefaultFormatter写入n个值（输出重定向到os.devnull），比较：
+        item：      逐个赋值，n次setter、n次通知、2n次print；
+        batch：     update_many()一次发布，每个格式化器一次格式化整批并print一次。
+    :param n:       int     值的个数
+    :return:
+    """
+    values = array('q', range(n))
+    for name in ('item', 'batch'):
+        df = DefaultFormatter(name)
+        df.add(HexFormatter())
+        df.add(BinaryFormatter())
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            if name == 'item':
+                for value in values:
+                    df.data = value
+            else:
+                df.update_many(values)
+            elapsed = time.perf_counter() - start
+
+        print('{:<6} {} values in {:.3f}s, {:>12,.0f} values/s, data = {}'.format(name, n, elapsed, n / elapsed, df.data))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# 开头提到可以用RabbitMQ做跨进程的发布-订阅，而Publisher只能在一个进程内通知观察者。
+# RemoteObserver是一个本地的观察者，把更新转发给另一个进程里的真正观察者：
+#     1）传输用multiprocessing.Pipe（Linux上是Unix域socketpair），不需要另外的消息服务；
+#     2）批量：更新先进发件箱，攒够batch_size个（或flush()/wait()时）作为一条消息发出，notify_batch()整批转发；
+#        linger是发件箱的延迟上限：第一个进入空发件箱的更新最多等待linger秒，低频发布时不会一直攒不满而不发。
+#        和CoalescingPublisher一样，由每个RemoteObserver唯一的一个常驻节拍线程按截止时间flush，
+#        notify()发现已过截止时间时也会立即flush；
+#     3）有界队列：已发出、未确认的更新最多max_unacked个，超过时发布者等待订阅进程确认（背压）；
+#     4）至少一次(at-least-once)投递：每个更新带有序号，订阅进程处理完一批后确认最后的序号；
+#        订阅进程崩溃时（连接断开），restart()启动新进程并按顺序重发所有未确认的更新，
+#        所以更新可能被重复处理（计入redelivered），但不会丢失。订阅进程会跳过已处理过的序号。
+#        观察者处理某个更新时抛出的异常只会被打印，该更新照常确认；
+#        连续重启超过max_restarts次（比如某条更新总让订阅进程崩溃，重发时连接又断开也算一次）时，
+#        RemoteObserver打印错误并标记为dead，之后的更新直接丢弃（计入lost），而不是无限重发；
+#        也不抛出异常，否则异常会穿过发布者的通知循环，排在它后面的观察者收不到这次更新。
+# 订阅进程中的观察者由factory(*args)创建，收到的是Update快照；观察者有report()方法时，close()返回它的结果。
+
+
+def _subscribe(conn, factory, args, quiet):
+    """
+    订阅进程的主循环：逐批通知观察者并确认，收到None时发回report()的结果并退出
+    :param conn:        obj     Pipe的一端
+    :param factory:     obj     创建观察者的可调用对象（需能被pickle，如模块级的类）
+    :param args:        tuple   factory的参数
+    :param quiet:       bool    是否把订阅进程的stdout重定向到os.devnull
+    """
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+    observer = factory(*args)
+    last = -1
+    while True:
+        batch = pickle.loads(conn.recv_bytes())
+        if batch is None:
+            break
+
+        for seq, name, data in batch:
+            # 重发的更新里可能有已经处理过的
+            if seq > last:
+                # 观察者处理失败的更新同样确认，否则订阅进程崩溃、重启后重发同一条，会无限循环
+                try:
+                    observer.notify(Update(name, data))
+                except Exception as e:
+                    print('Failed to notify {}: {}'.format(observer, e), file=sys.stderr)
+                last = seq
+        conn.send_bytes(pickle.dumps(last))
+
+    report = getattr(observer, 'report', None)
+    conn.send_bytes(pickle.dumps(report() if report is not None else None))
+    conn.close()
+
+
+class RemoteObserver:
+    def __init__(self, factory, *args, batch_size=256, linger=0.005, max_unacked=4096, max_restarts=3, quiet=False):
+        """
+        :param factory:         obj     在订阅进程中创建观察者的可调用对象
+        :param args:            tuple   factory的参数
+        :param batch_size:      int     发件箱攒够多少个更新时自动发送
+        :param linger:          float   发件箱中的更新最多等待多少秒就发送，None表示只在攒够或flush()时发送
+        :param max_unacked:     int     最多有多少个已发出、未确认的更新
+        :param max_restarts:    int     确认有进展之前最多连续重启几次
+        :param quiet:           bool    是否屏蔽订阅进程的输出
+        """
+        self.factory = factory
+        self.args = args
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_unacked = max_unacked
+        self.max_restarts = max_restarts
+        self.quiet = quiet
+        self.outbox = []
+        # 已发出、未确认的更新(seq, name, data)，按序号排列
+        self.unacked = deque()
+        self.seqs = itertools.count()
+        self.acked = 0
+        self.redelivered = 0
+        self.restarts = 0
+        # 上次确认之后的连续重启次数
+        self.failures = 0
+        # 订阅进程反复崩溃后放弃投递，error是原因
+        self.dead = False
+        self.error = None
+        self.lost = 0
+        # 节拍线程和发布者线程都会flush，用RLock保证批次按序号顺序发出
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.ticker = None
+        self.closed = False
+        self.deadline = None
+        self.process = None
+        self._start()
+
+    def _start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_subscribe, args=(child, self.factory, self.args, self.quiet),
+                                               daemon=True)
+        self.process.start()
+        child.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def notify(self, publisher):
+        with self.lock:
+            if self.dead:
+                self.lost += 1
+                return
+            self._arm()
+            self.outbox.append((next(self.seqs), publisher.name, publisher.data))
+            if len(self.outbox) >= self.batch_size or time.monotonic() >= self.deadline:
+                self.flush()
+
+    def notify_batch(self, publisher, values):
+        name = publisher.name
+        with self.lock:
+            if self.dead:
+                self.lost += len(values)
+                return
+            for i, value in enumerate(values):
+                self._arm()
+                self.outbox.append((next(self.seqs), name, value))
+                if len(self.outbox) >= self.batch_size:
+                    self.flush()
+                    if self.dead:
+                        self.lost += len(values) - i - 1
+                        return
+            if self.outbox and time.monotonic() >= self.deadline:
+                self.flush()
+
+    def _arm(self):
+        """发件箱为空时，为即将进入的第一个更新设置截止时间"""
+        if self.outbox:
+            return
+        if self.linger is None:
+            self.deadline = float('inf')
+            return
+        self.deadline = time.monotonic() + self.linger
+        if self.ticker is None:
+            self._start_ticker()
+        self.wakeup.set()
+
+    def _start_ticker(self):
+        """
+        启动常驻的节拍线程。线程只持有RemoteObserver的弱引用，对象被回收后线程在下一次醒来时退出。
+        """
+        remote = weakref.ref(self)
+        wakeup = self.wakeup
+
+        def run():
+            while True:
+                self_ = remote()
+                if self_ is None or self_.closed:
+                    return
+                with self_.lock:
+                    deadline = self_.deadline if self_.outbox else None
+                    if deadline is not None and time.monotonic() >= deadline:
+                        self_.flush()
+                        deadline = None
+                del self_
+                # 发件箱为空时也定期醒来，检查对象是否已被回收
+                timeout = 1.0 if deadline is None else max(deadline - time.monotonic(), 0)
+                wakeup.wait(timeout)
+                wakeup.clear()
+
+        self.ticker = threading.Thread(target=run, name='remote-observer-ticker', daemon=True)
+        self.ticker.start()
+
+    def _ack(self, seq):
+        unacked = self.unacked
+        while unacked and unacked[0][0] <= seq:
+            unacked.popleft()
+            self.acked += 1
+            self.failures = 0
+
+    def flush(self):
+        """把发件箱作为一批发出；未确认的更新太多时先等待确认"""
+        with self.lock:
+            if self.outbox and not self.dead:
+                self._flush()
+
+    def _flush(self):
+        batch, self.outbox = self.outbox, []
+        # 只有已发出的更新才会被确认，所以只等待已发出的部分；batch比max_unacked还大时等到全部确认后再发
+        try:
+            while self.conn.poll() or (self.unacked and len(self.unacked) + len(batch) > self.max_unacked):
+                self._ack(pickle.loads(self.conn.recv_bytes()))
+        except (EOFError, OSError):
+            # restart()会按顺序重发所有未确认的更新，包括这一批
+            self.unacked.extend(batch)
+            self.restart()
+            return
+
+        self.unacked.extend(batch)
+        try:
+            self.conn.send_bytes(pickle.dumps(batch, pickle.HIGHEST_PROTOCOL))
+        except (EOFError, OSError):
+            self.restart()
+
+    def restart(self):
+        """
+        重新启动订阅进程，并按顺序重发所有未确认的更新
+        :return:        bool    是否成功；连续失败max_restarts次后标记为dead
+        """
+        with self.lock:
+            while self.failures < self.max_restarts:
+                self.failures += 1
+                self.restarts += 1
+                self._stop()
+                self._start()
+
+                pending = list(self.unacked)
+                self.redelivered += len(pending)
+                try:
+                    for offset in range(0, len(pending), self.batch_size):
+                        self.conn.send_bytes(pickle.dumps(pending[offset:offset + self.batch_size],
+                                                          pickle.HIGHEST_PROTOCOL))
+                except (EOFError, OSError):
+                    # 重发时新进程又崩溃了，同样算一次失败
+                    continue
+                return True
+
+            self.dead = True
+            self.error = RuntimeError('Subscriber {} crashed {} times without progress'.format(
+                self.factory.__name__, self.failures))
+            self.lost += len(self.unacked) + len(self.outbox)
+            self.unacked.clear()
+            self.outbox = []
+            self._stop()
+            print('{}, dropping updates'.format(self.error), file=sys.stderr)
+            return False
+
+    def _stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+    def wait(self):
+        """发出发件箱中的更新，并等待所有更新都被确认"""
+        with self.lock:
+            self.flush()
+            while self.unacked:
+                try:
+                    self._ack(pickle.loads(self.conn.recv_bytes()))
+                except (EOFError, OSError):
+                    if not self.restart():
+                        return
+
+    def close(self):
+        """
+        :return:        obj     订阅进程中观察者report()的结果，dead时为None
+        """
+        # 先停止节拍线程，之后只有调用者会flush
+        self.closed = True
+        if self.ticker is not None:
+            self.wakeup.set()
+            self.ticker.join()
+            self.ticker = None
+        if self.process is None:
+            return None
+        if self.dead:
+            self.process = None
+            return None
+
+        self.wait()
+        if self.dead:
+            self.process = None
+            return None
+        self.conn.send_bytes(pickle.dumps(None))
+        report = pickle.loads(self.conn.recv_bytes())
+        self.process.join()
+        self.conn.close()
+        self.process = None
+        return report
+
+    def stats(self):
+        with self.lock:
+            return {'acked': self.acked, 'unacked': len(self.unacked) + len(self.outbox),
+                    'redelivered': self.redelivered, 'restarts': self.restarts, 'lost': self.lost,
+                    'dead': self.dead}
+
+
+class LatencyRecorder:
+    """
+    订阅进程中的观察者：data是发布时的time.monotonic_ns()（系统范围的单调时钟，跨进程可比），记录投递延迟
+    """
+    def __init__(self):
+        self.latencies = []
+
+    def notify(self, publisher):
+        self.latencies.append(time.monotonic_ns() - publisher.data)
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        return {'count': len(latencies), 'p50': percentile(latencies, 50) / 1e3,
+                'p99': percentile(latencies, 99) / 1e3, 'max': latencies[-1] / 1e3}
+
+
+class SequenceRecorder:
+    """
+    订阅进程中的观察者：记录收到的值，用来检查有没有丢失
+    """
+    def __init__(self):
+        self.seen = []
+
+    def notify(self, publisher):
+        self.seen.append(publisher.data)
+
+    def report(self):
+        return self.seen
+
+
+def remote_observer_main(n=100000, subscribers=4, batch_sizes=(1, 256)):
+    """
+    1）一个DefaultFormatter向subscribers个订阅进程发布n个值（值为当前的time.monotonic_ns()），
+       比较不同batch_size下的吞吐量（投递数/秒，n × subscribers）和投递延迟（微秒）；
+    2）发布途中杀掉订阅进程，检查重启后所有值都被投递（至少一次）。
+    :param n:               int     发布次数
+    :param subscribers:     int     订阅进程数
+    :param batch_sizes:     tuple   要比较的batch_size
+    :return:
+    """
+    for batch_size in batch_sizes:
+        count = n if batch_size > 1 else n // 10
+        df = DefaultFormatter('clock')
+        remotes = [RemoteObserver(LatencyRecorder, batch_size=batch_size) for _ in range(subscribers)]
+        for remote in remotes:
+            df.add(remote)
+
+        start = time.perf_counter()
+        for _ in range(count):
+            df.data = time.monotonic_ns()
+        for remote in remotes:
+            remote.wait()
+        elapsed = time.perf_counter() - start
+
+        reports = [remote.close() for remote in remotes]
+        print('batch {:>4}: {} x {} delivered in {:.3f}s, {:>10,.0f} deliveries/s, '
+              'p50 {:.0f}us, p99 {:.0f}us, max {:.0f}us'.format(
+                batch_size, count, subscribers, elapsed, count * subscribers / elapsed,
+                max(r['p50'] for r in reports), max(r['p99'] for r in reports), max(r['max'] for r in reports)))
+
+    df = DefaultFormatter('failover')
+    remote = RemoteObserver(SequenceRecorder, batch_size=64, max_unacked=512)
+    df.add(remote)
+    for i in range(n):
+        df.data = i
+        if i == n // 2:
+            # 模拟订阅进程崩溃，之前已确认的值随旧进程一起丢失，新进程从第一个未确认的值开始收到
+            remote.process.kill()
+    seen = remote.close()
+    print('failover: {}, new process got {}..{}, missing {}'.format(
+        remote.stats(), seen[0], seen[-1], sorted(set(range(seen[0], n)) - set(seen))))
+
 
 def main():
     df = DefaultFormatter('test1')
@@ -15,11 +15,33 @@
         4）智能（引用）代理：在对象被访问时执行额外的动作。此类代理的例子包括引用计数和线程安全检查。
 """
 
+import os
+import sys
+import time
+import hmac
+import pickle
+import asyncio
+import hashlib
+import secrets
+import json
+import inspect
+import itertools
+import multiprocessing
+from collections import deque
+import threading
+import contextlib
+import tracemalloc
+
+from benchmark import measure, percentile
+
 # -------------------------------------------------------------------------------------------------------------------
 """
 虚拟代理
 """
 
+# 表示“还没有值”的哨兵，None也可能是合法的值
+_MISSING = object()
+
 
 class LazyProperty:
     """
@@ -28,13 +50,49 @@ class LazyProperty:
     该类实际上是一个描述符。
     描述符(descriptor)是Python中重写类属性访问方法（__get__()、__set__()和__delete__()）的默认行为要使用的一种推荐机制。
     该类仅重写了__get__()方法，因为这是器需要重写的唯一访问方法。我们无需重写所有方法。
+
+    线程安全：第一次访问时，描述符在一把短暂持有的锁(guard)内检查是否已初始化，并为该实例登记一个“初始化中”标记
+    （inflight，按id(obj)保存在描述符里，不放进实例的状态，实例仍然可以pickle/deepcopy）。
+    其它线程看到标记后等待初始化完成再重新检查，因此多个线程同时访问也只初始化一次；
+    初始化方法运行时不持有任何共享的锁，不同实例的初始化互不阻塞，初始化方法里读取其它实例的惰性属性也不会死锁。
+
+    两种模式：
+        1）ttl为None（默认）：初始化后值直接存为实例属性，之后的读取根本不经过描述符，与读普通属性一样快；
+           用LazyProperty.invalidate(obj, name)或del obj.name作废，下次访问重新初始化。
+        2）ttl不为None：值和过期时间存在实例的'_lazy_<name>'属性中，每次读取都经过描述符检查是否过期，
+           过期后重新初始化。也可以用LazyProperty.invalidate(obj, name)提前作废。
+    用法：@LazyProperty 或 @LazyProperty(ttl=60)
+
+    __slots__类：实例没有__dict__，需要在__slots__中为每个惰性属性声明一个存储槽'_lazy_<name>'
+    （见LazyProperty.slot_name()），值（ttl模式下为(值, 过期时间)）保存在这个槽里，每次读取都经过描述符。
+    初始化时同样使用描述符里的“初始化中”标记，而不是在初始化期间持有共享的锁。
+    通过类访问（如Test.resource）时返回描述符本身。
     """
-    def __init__(self, method):
-        self.method = method
-        self.method_name = method.__name__
+    def __init__(self, method=None, ttl=None):
+        self.ttl = ttl
+        if method is not None:
+            self._bind(method)
         # print('function overrider: {}'.format(self.fget))
         # print("function's name: {}".format(self.func_name))
 
+    def __call__(self, method):
+        """@LazyProperty(ttl=...)的写法：先创建描述符，再修饰方法"""
+        self._bind(method)
+        return self
+
+    def _bind(self, method):
+        self.method = method
+        self.method_name = method.__name__
+        self.cache_name = '_lazy_{}'.format(self.method_name)
+        self.guard = threading.Lock()
+        self.inflight = {}
+        self.__doc__ = method.__doc__
+
+    @staticmethod
+    def slot_name(name):
+        """__slots__类中为惰性属性name声明的存储槽的名字"""
+        return '_lazy_{}'.format(name)
+
     def __get__(self, obj, cls):
         """
         __get__()方法所访问的特性值，正是下层方法想要赋的值，并用setattr()来手动赋值。
@@ -69,14 +127,121 @@ class LazyProperty:
 
         """
 
-        if not obj:
-            return None
+        # 用is判断，否则空容器之类的"假"实例也会被当成类访问
+        if obj is None:
+            return self
+
+        try:
+            obj.__dict__
+        except AttributeError:
+            return self._get_slot(obj, cls)
+
+        if self.ttl is not None:
+            return self._get_ttl(obj)
+
+        def store(value):
+            print('value {}'.format(value))
+            setattr(obj, self.method_name, value)
+
+        return self._initialize(obj, lambda: obj.__dict__.get(self.method_name, _MISSING), store)
 
-        value = self.method(obj)
-        print('value {}'.format(value))
-        setattr(obj, self.method_name, value)
+    def _initialize(self, obj, load, store):
+        """
+        只初始化一次：load()返回已有的值或_MISSING，没有时由第一个线程调用self.method(obj)并store(value)，
+        其它线程等它完成后重新load()（初始化失败时由下一个线程重试）。
+        """
+        key = id(obj)
+        while True:
+            with self.guard:
+                value = load()
+                if value is not _MISSING:
+                    return value
+
+                flight = self.inflight.get(key)
+                if flight is None:
+                    flight = self.inflight[key] = (threading.get_ident(), threading.Event())
+                    break
+
+            if flight[0] == threading.get_ident():
+                raise RuntimeError("LazyProperty '{}' accessed during its own initialization".format(self.method_name))
+            flight[1].wait()
+
+        try:
+            value = self.method(obj)
+            store(value)
+        finally:
+            with self.guard:
+                del self.inflight[key]
+            flight[1].set()
         return value
 
+    def _get_ttl(self, obj):
+        entry = obj.__dict__.get(self.cache_name)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+
+        def load():
+            entry = obj.__dict__.get(self.cache_name)
+            return entry[0] if entry is not None and entry[1] > time.monotonic() else _MISSING
+
+        def store(value):
+            obj.__dict__[self.cache_name] = (value, time.monotonic() + self.ttl)
+
+        return self._initialize(obj, load, store)
+
+    def _slot(self, cls):
+        slot = getattr(cls, self.cache_name, None)
+        if slot is None or not hasattr(slot, '__set__'):
+            raise TypeError("{} has no __dict__, declare a slot named '{}' for LazyProperty '{}'".format(
+                cls.__name__, self.cache_name, self.method_name))
+        return slot
+
+    def _get_slot(self, obj, cls):
+        slot = self._slot(cls)
+        try:
+            entry = slot.__get__(obj, cls)
+        except AttributeError:
+            pass
+        else:
+            if self.ttl is None:
+                return entry
+            if entry[1] > time.monotonic():
+                return entry[0]
+
+        def load():
+            try:
+                entry = slot.__get__(obj, cls)
+            except AttributeError:
+                return _MISSING
+            if self.ttl is None:
+                return entry
+            return entry[0] if entry[1] > time.monotonic() else _MISSING
+
+        def store(value):
+            slot.__set__(obj, value if self.ttl is None else (value, time.monotonic() + self.ttl))
+
+        return self._initialize(obj, load, store)
+
+    @staticmethod
+    def invalidate(obj, name):
+        """
+        作废obj上名为name的惰性属性，下次访问时重新初始化
+        :param obj:     obj     实例
+        :param name:    str     属性名（即被修饰方法的名字）
+        """
+        cache_name = LazyProperty.slot_name(name)
+        try:
+            storage = obj.__dict__
+        except AttributeError:
+            try:
+                delattr(obj, cache_name)
+            except AttributeError:
+                pass
+            return
+
+        storage.pop(name, None)
+        storage.pop(cache_name, None)
+
 
 class Test:
     """
@@ -120,6 +285,270 @@ def main():
     print(t.resource)
 
 
+class SlowResource:
+    """lazy_main()使用的类，resource的初始化耗时delay秒，initialized记录初始化次数"""
+    delay = 0.05
+
+    def __init__(self):
+        self.initialized = 0
+        self.plain = 'foo'
+
+    @LazyProperty
+    def resource(self):
+        self.initialized += 1
+        time.sleep(self.delay)
+        return tuple(range(5))
+
+    @LazyProperty(ttl=0.1)
+    def fresh(self):
+        self.initialized += 1
+        return time.monotonic()
+
+
+def lazy_main(threads=32):
+    """
+    1）threads个线程同时第一次读取resource，只初始化一次，总耗时约为一次初始化的时间；
+    2）初始化之后读取resource与读取普通属性的耗时对比；
+    3）invalidate之后重新初始化；ttl过期后重新初始化。
+    :param threads:     int     线程数
+    :return:
+    """
+    obj = SlowResource()
+    barrier = threading.Barrier(threads)
+
+    def reader():
+        barrier.wait()
+        obj.resource
+
+    workers = [threading.Thread(target=reader) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print('{} threads, contended first access: {:.4f}s, initialized {} time(s)'.format(
+        threads, time.perf_counter() - start, obj.initialized))
+
+    lazy = measure(lambda: obj.resource)
+    plain = measure(lambda: obj.plain)
+    print('read after init: lazy {:.1f}ns, plain attribute {:.1f}ns'.format(lazy['median'] * 1e9,
+                                                                          plain['median'] * 1e9))
+    ttl = measure(lambda: obj.fresh)
+    print('read with ttl: {:.1f}ns'.format(ttl['median'] * 1e9))
+
+    initialized = obj.initialized
+    LazyProperty.invalidate(obj, 'resource')
+    obj.resource
+    first = obj.fresh
+    time.sleep(0.15)
+    changed = obj.fresh != first
+    print('after invalidate and ttl expiry: initialized {} more time(s), fresh changed: {}'.format(
+        obj.initialized - initialized, changed))
+
+
+class DictPoint:
+    """slots_main()的对照组：普通类，惰性属性存在__dict__里"""
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    @LazyProperty
+    def norm(self):
+        return (self.x ** 2 + self.y ** 2) ** 0.5
+
+
+class SlotsPoint:
+    """__slots__类，为惰性属性norm声明了存储槽"""
+    __slots__ = ('x', 'y', LazyProperty.slot_name('norm'))
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    @LazyProperty
+    def norm(self):
+        return (self.x ** 2 + self.y ** 2) ** 0.5
+
+
+class Bag(list):
+    """空的时候是"假"的，以前的if not obj会让它的惰性属性永远返回None"""
+    @LazyProperty
+    def label(self):
+        return 'bag of {}'.format(len(self))
+
+
+def slots_main(n=100000):
+    """
+    用tracemalloc统计n个实例（惰性属性均已初始化）平均每个占用的字节数，对比__dict__版本与__slots__版本。
+    __dict__版本初始化时__get__()中演示用的print被重定向到os.devnull。
+    :param n:       int     实例个数
+    :return:
+    """
+    print('class access returns descriptor: {}'.format(isinstance(SlotsPoint.norm, LazyProperty)))
+    print('falsy instance: {!r}'.format(Bag().label))
+
+    with open(os.devnull, 'w') as devnull:
+        for cls in (DictPoint, SlotsPoint):
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            points = [cls(i, i + 1) for i in range(n)]
+            with contextlib.redirect_stdout(devnull):
+                for point in points:
+                    point.norm
+            used = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            print('{}: {:.1f} bytes/instance'.format(cls.__name__, used / n))
+            del points
+
+
+# -------------------------------------------------------------------------------------------------------------------
+"""
+异步虚拟代理
+LazyProperty假设初始化是同步的（如tuple(range(5))），但真正昂贵的资源往往是异步连接。
+AsyncLazyResource在第一次await时才调用异步工厂函数创建资源：
+    1）并发的await共享同一个初始化Task，工厂函数只执行一次；每个等待者通过asyncio.shield()等待，
+       某个等待者被取消不会取消初始化本身；
+    2）初始化失败不缓存，异常传给这一轮的所有等待者，下一次await重新初始化；
+    3）close()关闭资源：有closer时调用await closer(resource)，否则调用资源的aclose()或close()（是协程就await）；
+       正在初始化时会先等它完成再关闭。关闭后再次await会重新初始化。
+用法：
+    db = AsyncLazyResource(connect)
+    conn = await db              # 或 await db.get()
+    async with db: ...           # 退出时自动close()
+"""
+
+
+class AsyncLazyResource:
+    def __init__(self, factory, closer=None):
+        """
+        :param factory:     obj     无参数的协程函数，返回资源
+        :param closer:      obj     协程函数closer(resource)，None表示使用资源自己的aclose()/close()
+        """
+        self.factory = factory
+        self.closer = closer
+        self.resource = None
+        self.initialized = False
+        self.task = None
+
+    def __await__(self):
+        return self.get().__await__()
+
+    async def get(self):
+        if self.initialized:
+            return self.resource
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.factory())
+            self.task.add_done_callback(self._settle)
+        return await asyncio.shield(self.task)
+
+    def _settle(self, task):
+        if self.task is task:
+            self.task = None
+
+        # task.exception()同时标记异常已被获取，避免"Task exception was never retrieved"警告
+        if not task.cancelled() and task.exception() is None:
+            self.resource = task.result()
+            self.initialized = True
+
+    async def close(self):
+        if self.task is not None:
+            try:
+                await asyncio.shield(self.task)
+            except Exception:
+                return
+
+        if not self.initialized:
+            return
+
+        resource, self.resource, self.initialized = self.resource, None, False
+        if self.closer is not None:
+            await self.closer(resource)
+            return
+
+        close = getattr(resource, 'aclose', None) or getattr(resource, 'close', None)
+        if close is not None:
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+
+    async def __aenter__(self):
+        return await self.get()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class FakeConnection:
+    """async_lazy_main()使用的模拟异步连接"""
+    opened = 0
+    closed = 0
+
+    def __init__(self):
+        FakeConnection.opened += 1
+
+    @classmethod
+    async def connect(cls, delay=0.05):
+        await asyncio.sleep(delay)
+        return cls()
+
+    async def aclose(self):
+        await asyncio.sleep(0)
+        FakeConnection.closed += 1
+
+
+def async_lazy_main(awaiters=10000):
+    """
+    1）awaiters个协程同时第一次访问资源，只建立一次连接，总耗时约为一次连接的时间；
+    2）初始化后await的开销；
+    3）初始化失败不会被缓存；
+    4）close()关闭连接。
+
+    Out（示例）:
+    10000 concurrent first accesses: 0.2957s, connections opened: 1
+    await after init: 0.67us
+    Error: connection refused
+    retry after failure: connections opened 2
+    connections closed: 1
+    :param awaiters:    int     并发访问的协程数
+    :return:
+    """
+    async def run():
+        db = AsyncLazyResource(FakeConnection.connect)
+
+        start = time.perf_counter()
+        connections = await asyncio.gather(*[db.get() for _ in range(awaiters)])
+        print('{} concurrent first accesses: {:.4f}s, connections opened: {}'.format(
+            awaiters, time.perf_counter() - start, len(set(map(id, connections)))))
+
+        rounds = 100000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await db
+        print('await after init: {:.2f}us'.format((time.perf_counter() - start) / rounds * 1e6))
+
+        attempts = []
+
+        async def flaky():
+            attempts.append(None)
+            if len(attempts) == 1:
+                raise ConnectionError('connection refused')
+            return await FakeConnection.connect(0)
+
+        retry = AsyncLazyResource(flaky)
+        try:
+            await retry
+        except ConnectionError as e:
+            print('Error: {}'.format(e))
+        await retry
+        print('retry after failure: connections opened {}'.format(FakeConnection.opened))
+
+        await db.close()
+        print('connections closed: {}'.format(FakeConnection.closed))
+
+    asyncio.run(run())
+
+
 # ---------------------------------------------------------------------------------------------------------------------
 """
 现实生活中的例子：
@@ -141,15 +570,96 @@ def main():
 
 
 class SensitiveInfo:
+    """
+    users只追加、不删除，因此下标可以直接作为分页的游标(cursor)，翻页期间有新用户加入也不会错位。
+    index是users的集合，重复添加在O(1)内被拒绝。
+    chunks是users[:rendered_count]渲染好的若干段字符串，按空格连接就是全部用户：read()时只把新增的用户join成一段追加上去，
+    并直接把各段交给print()写出，不再把整个字符串复制一遍。为了让段数保持在O(log n)，
+    新段不短于前一段时把两段合并（和二进制计数器进位一样），每个用户名平均只被复制O(log n)次，而不是每次读取都复制全部。
+    只有snapshot()需要完整的字符串时才join一次，并把结果作为唯一的一段保存。
+    """
     def __init__(self):
         self.users = ['nick', 'tom', 'ben', 'mike']
+        self.index = set(self.users)
+        self.chunks = []
+        self.rendered_count = 0
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, user):
+        return user in self.index
+
+    def _render(self):
+        """把还没渲染的用户追加为新的一段"""
+        if self.rendered_count < len(self.users):
+            chunks = self.chunks
+            chunks.append(' '.join(self.users[self.rendered_count:]))
+            self.rendered_count = len(self.users)
+            while len(chunks) > 1 and len(chunks[-2]) <= len(chunks[-1]):
+                last = chunks.pop()
+                chunks[-1] = '{} {}'.format(chunks[-1], last)
+        return self.chunks
+
+    def snapshot(self):
+        """所有用户名以空格分隔拼成的字符串"""
+        chunks = self._render()
+        if len(chunks) > 1:
+            chunks[:] = [' '.join(chunks)]
+        return chunks[0] if chunks else ''
 
     def read(self):
-        print('There are {} users: {}'.format(len(self.users), ' '.join(self.users)))
+        print('There are {} users:'.format(len(self.users)), *self._render())
+
+    def page(self, cursor=0, limit=100):
+        """
+        分页读取
+        :param cursor:      int     从第几个用户开始，第一页为0
+        :param limit:       int     每页最多多少个用户
+        :return:            tuple   (用户列表, 下一页的游标)，没有下一页时游标为None
+        """
+        if cursor < 0 or limit <= 0:
+            raise ValueError('cursor must be >= 0 and limit must be > 0')
+
+        users = self.users[cursor:cursor + limit]
+        following = cursor + len(users)
+        return users, following if following < len(self.users) else None
+
+    def stream(self, cursor=0, batch=1000):
+        """
+        流式读取：从cursor开始每次产出最多batch个用户，直到读完（包括读取期间新加入的用户）
+        :return:            obj     生成器
+        """
+        while cursor is not None:
+            users, cursor = self.page(cursor, batch)
+            if users:
+                yield users
 
     def add(self, user):
+        """
+        :return:        bool    是否添加成功，用户已存在时返回False
+        """
+        if user in self.index:
+            print('User {} already exists'.format(user))
+            return False
+
         self.users.append(user)
+        self.index.add(user)
         print('Added user {}'.format(user))
+        return True
+
+    def add_many(self, users):
+        """
+        批量添加，跳过已存在（包括本批中重复）的用户，只打印一行汇总
+        :param users:   list    用户名序列
+        :return:        int     实际添加的个数
+        """
+        index = self.index
+        added = [user for user in dict.fromkeys(users) if user not in index]
+        self.users.extend(added)
+        index.update(added)
+        print('Added {} users'.format(len(added)))
+        return len(added)
 
 
 class Info:
@@ -159,17 +669,76 @@ class Info:
         1）在源码中存储密码；
         2）以明文形式存储密码；
         3）使用一种弱（例如，MD5）货自定义加密形式。
+
+    因此这里不保存明文secret，只保存随机盐salt和PBKDF2-HMAC-SHA256的结果secret_hash，
+    比较时用hmac.compare_digest()，耗时与两者在第几个字节不同无关（恒定时间比较），不会泄露信息。
+    （默认密码仍写在源码里，仅为演示。）
+
+    add()每添加一个用户都要在终端输入一次密码，无法批量导入。批量接口：
+        token = info.authenticate(secret)       # 验证一次，得到有效期token_ttl秒的会话令牌
+        info.add_many(token, users)             # 一次调用添加所有用户
     """
-    def __init__(self):
+    iterations = 100000
+
+    def __init__(self, secret='0xdeadbeef', token_ttl=60):
+        """
+        :param secret:      str     密码
+        :param token_ttl:   float   会话令牌的有效秒数
+        """
         self.protected = SensitiveInfo()
-        self.secret = '0xdeadbeef'
+        self.salt = secrets.token_bytes(16)
+        self.secret_hash = self._hash(secret)
+        self.token_ttl = token_ttl
+        self.sessions = {}
+
+    def _hash(self, secret):
+        return hashlib.pbkdf2_hmac('sha256', secret.encode(), self.salt, self.iterations)
+
+    def check(self, secret):
+        return hmac.compare_digest(self._hash(secret), self.secret_hash)
 
     def read(self):
         self.protected.read()
 
+    def page(self, cursor=0, limit=100):
+        return self.protected.page(cursor, limit)
+
+    def stream(self, cursor=0, batch=1000):
+        return self.protected.stream(cursor, batch)
+
     def add(self, user):
         sec = input('What is the secret? ')
-        self.protected.add(user) if sec == self.secret else print("That's wrong!")
+        self.protected.add(user) if self.check(sec) else print("That's wrong!")
+
+    def authenticate(self, secret):
+        """
+        验证密码，成功后返回会话令牌
+        :param secret:      str     密码
+        :return:            str     会话令牌
+        """
+        if not self.check(secret):
+            raise PermissionError("That's wrong!")
+
+        now = time.monotonic()
+        # 顺便清理已过期的令牌
+        self.sessions = {token: deadline for token, deadline in self.sessions.items() if deadline > now}
+        token = secrets.token_urlsafe(32)
+        self.sessions[token] = now + self.token_ttl
+        return token
+
+    def add_many(self, token, users):
+        """
+        用会话令牌批量添加用户，令牌无效或过期时抛出PermissionError
+        :param token:       str     authenticate()返回的令牌
+        :param users:       list    用户名序列
+        :return:            int     实际添加的个数
+        """
+        deadline = self.sessions.get(token)
+        if deadline is None or deadline <= time.monotonic():
+            self.sessions.pop(token, None)
+            raise PermissionError('Invalid or expired session token')
+
+        return self.protected.add_many(users)
 
 
 def secret_main():
@@ -193,6 +762,519 @@ def secret_main():
             print('unknown option: {}'.format(key))
 
 
+# ---------------------------------------------------------------------------------------------------------------------
+"""
+远程代理
+SensitiveInfo这样的对象放在一个工作进程里，本进程只持有一个替身RemoteProxy，调用它的方法就像调用本地对象：
+    proxy = RemoteProxy(SensitiveInfo)
+    proxy.add('alice')
+
+进程间通过multiprocessing.Pipe通信，每条消息都是一批请求[(请求号, 方法名, args, kwargs)]，
+回复是同样顺序的一批结果[(请求号, 是否成功, 返回值或异常)]，用pickle的最高协议序列化（紧凑的二进制格式）。
+    1）不批量：proxy.add('alice')，发一个请求、等一个回复，每次调用一个来回(round trip)；
+    2）批量：  proxy.submit('add', 'alice')只把请求放进发件箱，返回RemoteFuture；
+               发件箱攒够batch_size个或调用flush()时一次发出，很多小调用共用一个来回；
+    3）流水线：flush()发出后不等回复，可以继续提交、继续发送下一批，
+               直到调用RemoteFuture.result()时才按顺序读取回复，多批请求同时在途。
+               在途的批数超过max_inflight时，flush()会先读取最早一批的回复，否则双方都在写、都不读，
+               管道缓冲区写满后会互相阻塞（死锁）。
+工作进程按顺序执行请求，因此同一个代理上的调用保持提交顺序。RemoteProxy不是线程安全的，每个线程应使用自己的代理。
+"""
+
+
+def _picklable(reply):
+    """
+    :param reply:       tuple   (请求号, 是否成功, 返回值或异常)
+    :return:            tuple   能pickle时原样返回，否则换成(请求号, False, RuntimeError(repr(返回值或异常)))
+    """
+    try:
+        pickle.dumps(reply, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        request_id, ok, value = reply
+        return request_id, False, RuntimeError(repr(value))
+    return reply
+
+
+def _serve(conn, factory, args, quiet):
+    """
+    工作进程的主循环：创建对象，然后逐批执行请求，收到None时退出
+    :param conn:        obj     Pipe的一端
+    :param factory:     obj     创建对象的可调用对象（需能被pickle，如模块级的类）
+    :param args:        tuple   factory的参数
+    :param quiet:       bool    是否把工作进程的stdout重定向到os.devnull
+    """
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+    target = factory(*args)
+    while True:
+        batch = pickle.loads(conn.recv_bytes())
+        if batch is None:
+            break
+
+        replies = []
+        for request_id, name, call_args, call_kwargs in batch:
+            try:
+                replies.append((request_id, True, getattr(target, name)(*call_args, **call_kwargs)))
+            except Exception as e:
+                replies.append((request_id, False, e))
+
+        try:
+            data = pickle.dumps(replies, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # 有返回值或异常无法pickle时，只把这些回复换成RuntimeError，工作进程继续运行
+            data = pickle.dumps([_picklable(reply) for reply in replies], pickle.HIGHEST_PROTOCOL)
+        conn.send_bytes(data)
+
+    conn.close()
+
+
+class RemoteFuture:
+    """一次远程调用的结果，result()时才读取回复"""
+    __slots__ = ('proxy', 'request_id', 'done', 'ok', 'value')
+
+    def __init__(self, proxy, request_id):
+        self.proxy = proxy
+        self.request_id = request_id
+        self.done = False
+        self.ok = None
+        self.value = None
+
+    def result(self):
+        if not self.done:
+            self.proxy.wait(self)
+        if not self.ok:
+            raise self.value
+        return self.value
+
+
+class RemoteProxy:
+    def __init__(self, factory, *args, batch_size=128, max_inflight=4, quiet=False):
+        """
+        :param factory:         obj     在工作进程中创建被代理对象的可调用对象
+        :param args:            tuple   factory的参数
+        :param batch_size:      int     发件箱攒够多少个请求时自动发送
+        :param max_inflight:    int     最多同时在途（已发出、未读回复）的批数
+        :param quiet:           bool    是否屏蔽工作进程的输出
+        """
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+        self.outbox = []
+        # 已发出、还没读取回复的批，每批是一个RemoteFuture列表，按发送顺序排列
+        self.pending = deque()
+        self.ids = itertools.count()
+
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child, factory, args, quiet), daemon=True)
+        self.process.start()
+        child.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        method.__name__ = name
+        return method
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def call(self, name, *args, **kwargs):
+        """同步调用：发出请求（连同发件箱中已有的请求）并等待结果"""
+        future = self.submit(name, *args, **kwargs)
+        self.flush()
+        return future.result()
+
+    def submit(self, name, *args, **kwargs):
+        """
+        异步提交一次调用
+        :return:        obj     RemoteFuture
+        """
+        future = RemoteFuture(self, next(self.ids))
+        self.outbox.append((future, (future.request_id, name, args, kwargs)))
+        if len(self.outbox) >= self.batch_size:
+            self.flush()
+        return future
+
+    def flush(self):
+        """把发件箱中的请求作为一批发出，不等待回复"""
+        if not self.outbox:
+            return
+
+        # 先清空发件箱，无法pickle的请求不会留在里面让之后的每次flush()都失败
+        outbox, self.outbox = self.outbox, []
+        try:
+            data = pickle.dumps([request for _, request in outbox], pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # 逐个检查，无法pickle的请求直接以该异常失败，其余的照常发出
+            kept = []
+            for future, request in outbox:
+                try:
+                    pickle.dumps(request, pickle.HIGHEST_PROTOCOL)
+                except Exception as e:
+                    future.ok, future.value, future.done = False, e, True
+                else:
+                    kept.append((future, request))
+            outbox = kept
+            if not outbox:
+                return
+            data = pickle.dumps([request for _, request in outbox], pickle.HIGHEST_PROTOCOL)
+
+        while len(self.pending) >= self.max_inflight:
+            self._receive()
+
+        self.conn.send_bytes(data)
+        self.pending.append([future for future, _ in outbox])
+
+    def _receive(self):
+        """读取最早在途的一批回复"""
+        replies = pickle.loads(self.conn.recv_bytes())
+        for future, (request_id, ok, value) in zip(self.pending.popleft(), replies):
+            future.ok, future.value, future.done = ok, value, True
+
+    def wait(self, future):
+        """读取回复，直到future完成"""
+        if not future.done and any(queued is future for queued, _ in self.outbox):
+            self.flush()
+
+        while not future.done:
+            self._receive()
+
+    def close(self):
+        if self.process is None:
+            return
+
+        self.flush()
+        while self.pending:
+            self._receive()
+
+        self.conn.send_bytes(pickle.dumps(None))
+        self.process.join()
+        self.conn.close()
+        self.process = None
+
+
+def remote_main(calls=20000, batch_size=100):
+    """
+    比较不批量与批量（流水线）远程调用的吞吐量（calls/s）和p99延迟。
+    不批量时延迟是单次调用的来回时间；批量时延迟是一批中从提交到拿到结果的时间。
+    :param calls:       int     调用次数
+    :param batch_size:  int     每批的调用数
+    :return:
+    """
+    with RemoteProxy(SensitiveInfo, batch_size=batch_size, quiet=True) as proxy:
+        latencies = []
+        start = time.perf_counter()
+        for i in range(calls):
+            begin = time.perf_counter()
+            proxy.add('user{}'.format(i))
+            latencies.append(time.perf_counter() - begin)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        print('unbatched: {:.0f} calls/s, p99 latency {:.1f}us'.format(calls / elapsed, percentile(latencies, 99) * 1e6))
+
+        latencies = []
+        start = time.perf_counter()
+        for offset in range(0, calls, batch_size):
+            begin = time.perf_counter()
+            futures = [proxy.submit('add', 'batched{}'.format(i))
+                       for i in range(offset, min(offset + batch_size, calls))]
+            proxy.flush()
+            for future in futures:
+                future.result()
+            latencies.append(time.perf_counter() - begin)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        print('batched x{}: {:.0f} calls/s, p99 batch latency {:.1f}us'.format(
+            batch_size, calls / elapsed, percentile(latencies, 99) * 1e6))
+
+        start = time.perf_counter()
+        futures = [proxy.submit('add', 'pipelined{}'.format(i)) for i in range(calls)]
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+        print('pipelined x{}: {:.0f} calls/s'.format(batch_size, calls / elapsed))
+
+
+def users_main(n=10 ** 6, reads=20):
+    """
+    n个用户时：
+        1）每次add()之后read()：原来每次都重新join全部用户，现在只拼接新增的部分；
+        2）重复添加被O(1)拒绝；
+        3）分页和流式读取。
+    read()的输出写到os.devnull。
+    :param n:       int     用户数
+    :param reads:   int     "add一个用户再read一次"的轮数
+    :return:
+    """
+    info = SensitiveInfo()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for i in range(n):
+            info.add('user{}'.format(i))
+        added = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(reads):
+            info.add('late{}'.format(i))
+            print('There are {} users: {}'.format(len(info.users), ' '.join(info.users)))
+        rebuild = time.perf_counter() - start
+
+        info.read()
+        start = time.perf_counter()
+        for i in range(reads):
+            info.add('later{}'.format(i))
+            info.read()
+        incremental = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rejected = sum(not info.add('user{}'.format(i)) for i in range(0, n, 10))
+        duplicates = time.perf_counter() - start
+
+    print('added {} users: {:.0f} users/s'.format(n, n / added))
+    print('add + read x{}: rebuild join {:.4f}s, incremental snapshot {:.4f}s'.format(reads, rebuild, incremental))
+    print('rejected {} duplicates in {:.4f}s'.format(rejected, duplicates))
+
+    users, cursor = info.page(limit=3)
+    print('first page: {}, next cursor: {}'.format(users, cursor))
+    start = time.perf_counter()
+    streamed = sum(len(batch) for batch in info.stream(batch=10000))
+    print('streamed {} users in {:.4f}s'.format(streamed, time.perf_counter() - start))
+
+
+def bulk_main(n=100000):
+    """
+    非交互的批量导入：认证一次，add_many()一次添加n个用户，统计每秒导入的用户数。
+    :param n:       int     用户数
+    :return:
+    """
+    info = Info()
+
+    start = time.perf_counter()
+    token = info.authenticate('0xdeadbeef')
+    authenticated = time.perf_counter() - start
+
+    start = time.perf_counter()
+    added = info.add_many(token, ['user{}'.format(i) for i in range(n)])
+    elapsed = time.perf_counter() - start
+    print('authenticate: {:.4f}s, add_many: {} users in {:.4f}s, {:.0f} users/s'.format(
+        authenticated, added, elapsed, added / elapsed))
+
+    try:
+        info.authenticate('wrong')
+    except PermissionError as e:
+        print('Error: {}'.format(e))
+
+    info.token_ttl = 0
+    expired = info.authenticate('0xdeadbeef')
+    try:
+        info.add_many(expired, ['late'])
+    except PermissionError as e:
+        print('Error: {}'.format(e))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+"""
+智能（引用）代理：在对象被访问时执行额外的动作。
+InstrumentProxy包装任意对象（SensitiveInfo、facade.FileServer、interpreter.Boiler……），不修改被包装的类，
+记录每个方法的调用次数、总耗时和延迟直方图：
+    1）直方图按2的幂分桶，耗时t纳秒落在第t.bit_length()个桶，即[2**(b-1), 2**b)，记一次只是一次整数运算和列表加1；
+    2）第一次访问某个方法时生成计时包装函数并存入代理自己的__dict__，之后的访问不再经过__getattr__；
+    3）每个线程写自己的计数分片，记录时不加锁，多线程调用时计数也不会丢失；
+    4）snapshot()导出当前统计（p50/p90/p99/max按桶上界估算），export()写成JSON，reset()清零；
+    5）refs是当前存活的代理个数（引用计数），每创建/回收一个代理加/减1；
+    6）计时本身（两次perf_counter_ns加记录）有固定开销，sample > 1时每sample次调用只计时一次，
+       其余调用只多一次计数，适合长期开着；此时count是按采样估算的调用次数，sampled是实际计时的次数。
+非方法属性（如FileServer.state）直接透传，不做统计；给代理赋值会设置到被包装对象上。
+"""
+
+
+class MethodStats:
+    """
+    一个方法的统计数据。
+    为了让记录足够便宜，每个线程写自己的分片(shard)：shard[0]是总耗时，shard[b + 1]是第b个桶的次数。
+    只有所属线程会写一个分片，因此记录时不需要加锁，也不会丢失计数；snapshot()时把所有分片加起来。
+    """
+    __slots__ = ('lock', 'shards')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shards = {}
+
+    def shard(self):
+        """当前线程的分片，第一次调用时创建"""
+        with self.lock:
+            return self.shards.setdefault(threading.get_ident(), [0] * 66)
+
+    def snapshot(self):
+        with self.lock:
+            shards = list(self.shards.values())
+
+        total = sum(shard[0] for shard in shards)
+        buckets = [sum(column) for column in zip(*[shard[1:] for shard in shards])] or [0] * 65
+        count = sum(buckets)
+
+        def quantile(q):
+            """按桶上界估算的分位数（纳秒）"""
+            seen = 0
+            for bucket, hits in enumerate(buckets):
+                seen += hits
+                if hits and seen >= q * count:
+                    return 1 << bucket
+            return 0
+
+        return {'count': count,
+                'total_ns': total,
+                'mean_ns': total / count if count else 0,
+                'p50_ns': quantile(0.5),
+                'p90_ns': quantile(0.9),
+                'p99_ns': quantile(0.99),
+                'max_ns': quantile(1),
+                'buckets': {'<{}'.format(1 << bucket): hits for bucket, hits in enumerate(buckets) if hits}}
+
+
+class InstrumentProxy:
+    refs = 0
+    _refs_lock = threading.Lock()
+
+    def __init__(self, target, sample=1):
+        """
+        :param target:      obj     被包装的对象
+        :param sample:      int     每sample次调用计时一次，1表示每次都计时
+        """
+        if sample < 1:
+            raise ValueError('sample must be >= 1')
+
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_sample', sample)
+        object.__setattr__(self, '_stats', {})
+        object.__setattr__(self, '_lock', threading.Lock())
+        with InstrumentProxy._refs_lock:
+            InstrumentProxy.refs += 1
+        # __init__抛出异常时__del__仍会执行，只有真正计过数的代理才减1
+        object.__setattr__(self, '_counted', True)
+
+    def __del__(self):
+        # 直接查__dict__，缺少属性时不能走__getattr__转发到被包装对象
+        if self.__dict__.pop('_counted', False):
+            with InstrumentProxy._refs_lock:
+                InstrumentProxy.refs -= 1
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        with self._lock:
+            stats = self._stats.setdefault(name, MethodStats())
+        shards = stats.shards
+        new_shard = stats.shard
+        clock = time.perf_counter_ns
+        get_ident = threading.get_ident
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                shard = shards.get(get_ident()) or new_shard()
+                shard[0] += elapsed
+                shard[elapsed.bit_length() + 1] += 1
+
+        if self._sample > 1:
+            sample = self._sample
+            # itertools.count的__next__在C中完成，多线程下也不会重复或跳号
+            tick = itertools.count().__next__
+            measured = timed
+
+            def timed(*args, **kwargs):
+                if tick() % sample:
+                    return attr(*args, **kwargs)
+                return measured(*args, **kwargs)
+
+        timed.__name__ = name
+        timed.__doc__ = attr.__doc__
+        # 存入代理的__dict__，之后访问同名属性不再经过__getattr__
+        self.__dict__[name] = timed
+        return timed
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+        # 被替换的可能是方法，丢掉缓存的包装函数
+        self.__dict__.pop(name, None)
+
+    def __repr__(self):
+        return 'InstrumentProxy({!r})'.format(self._target)
+
+    def snapshot(self):
+        """
+        :return:        dict    {方法名: 统计}
+        """
+        with self._lock:
+            stats = list(self._stats.items())
+        snapshot = {name: method.snapshot() for name, method in stats}
+        if self._sample > 1:
+            for method in snapshot.values():
+                method['sampled'] = method['count']
+                method['count'] *= self._sample
+        return snapshot
+
+    def export(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'target': type(self._target).__name__, 'methods': self.snapshot()}, f, indent=2)
+
+    def reset(self):
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = MethodStats()
+                self.__dict__.pop(name, None)
+
+
+def instrument_main(threads=8, calls=20000):
+    """
+    1）直接调用与经过InstrumentProxy调用（每次计时、每16次计时一次）的耗时对比（额外开销）；
+    2）多线程通过同一个代理调用，计数不丢失；
+    3）包装facade.FileServer，导出统计。
+    :param threads:     int     线程数
+    :param calls:       int     每个线程的调用次数
+    :return:
+    """
+    from facade import FileServer
+
+    info = SensitiveInfo()
+    direct = measure(lambda: info.page(0, 2))
+    print('page(): direct {:.0f}ns'.format(direct['median'] * 1e9))
+    for sample in (1, 16):
+        proxied = InstrumentProxy(info, sample)
+        wrapped = measure(lambda: proxied.page(0, 2))
+        print('page(): instrumented, sample={}: {:.0f}ns, overhead {:.0f}ns'.format(
+            sample, wrapped['median'] * 1e9, (wrapped['median'] - direct['median']) * 1e9))
+
+    proxied.reset()
+    workers = [threading.Thread(target=lambda: [proxied.page(0, 2) for _ in range(calls)]) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print('{} threads x {} calls, recorded {}'.format(threads, calls, proxied.snapshot()['page']['count']))
+
+    server = InstrumentProxy(FileServer())
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server.boot()
+        for i in range(100):
+            server.create_file('foo', 'hello{}'.format(i), '-rw-r-r')
+        server.kill()
+    print('FileServer state: {}, refs: {}'.format(server.state, InstrumentProxy.refs))
+    print(json.dumps(server.snapshot(), indent=2))
+
+
 if __name__ == '__main__':
     # main()
     secret_main()